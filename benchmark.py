@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+''' Benchmark the bias-test.py fit loop on a small synthetic workspace.
+
+The workspace has the object names of the real combination (gg_mass,
+channellist, mHiggs, npbBSM, BIAS, bias_bb/bias_bj, bkg_constraint_*,
+novosibirsk_*, nbkg_fit_*), so that every bias-test.py option works on it.
+Each configuration of the matrix (number of trials x ghost on/off x offset
+on/off) is run as a separate bias-test.py job and timed from the per-stage
+times in its result file. The numbers go to a JSON file; --compare prints
+them next to those of an earlier run, e.g. of another commit:
+
+    ./benchmark.py --out before.json
+    git checkout ...
+    ./benchmark.py --out after.json --compare before.json
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import itertools
+import subprocess
+import numpy as np
+import resultstore
+import stagetimer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BIAS_TEST = os.path.join(HERE, 'bias-test.py')
+WS_NAME = 'synthetic_ws.root'
+
+def make_workspace(path):
+    ''' Write a two-category signal+background model like the real one '''
+    import ROOT as r
+    r.gROOT.SetBatch(1)
+    w = r.RooWorkspace("combination")
+    w.factory("gg_mass[250,650]")
+    w.factory("channellist[bb,bj]")
+    w.factory("mHiggs[300]")
+    w.factory("npbBSM[1,-5,20]")
+    w.factory("BIAS[0,-5,5]")
+    nps = ['BIAS']
+    w.factory("Gaussian::BIAS_constr(BIAS_glob[0],BIAS,1)")
+    models = []
+    for c, nbkg, peak in (('bb', 2000, 280), ('bj', 6000, 290)):
+        constraints = ['BIAS_constr']
+        for np_ in ('bias_%s', 'bkg_constraint_%s', 'bkg_constraint_shape_%s',
+                'bkg_constraint_tail_%s', 'bkg_constraint_width_%s'):
+            name = np_%c
+            w.factory("%s[0,-5,5]"%name)
+            w.factory("Gaussian::%s_constr(%s_glob[0],%s,1)"%(name, name, name))
+            constraints.append(name+'_constr')
+            nps.append(name)
+        # the shape parameters are fixed unless --free-shape, and respond
+        # to their constraint NPs
+        w.factory("novosibirsk_peak_%s[%g,250,400]"%(c, peak))
+        w.factory("novosibirsk_width_%s[40,5,150]"%c)
+        w.factory("novosibirsk_tail_%s[-0.5,-2,2]"%c)
+        w.factory("nbkg_fit_%s_%s[%g,0,1e6]"%(c, c, nbkg))
+        for v in ('novosibirsk_peak_%s', 'novosibirsk_width_%s', 'novosibirsk_tail_%s', 'nbkg_fit_%s_%s'):
+            w.var(v.replace('%s', c)).setConstant(True)
+        w.factory("expr::peak_%s('novosibirsk_peak_%s*(1+0.01*bkg_constraint_shape_%s)',novosibirsk_peak_%s,bkg_constraint_shape_%s)"%((c,)*5))
+        w.factory("expr::width_%s('novosibirsk_width_%s*(1+0.05*bkg_constraint_width_%s)',novosibirsk_width_%s,bkg_constraint_width_%s)"%((c,)*5))
+        w.factory("expr::tail_%s('novosibirsk_tail_%s*(1+0.05*bkg_constraint_tail_%s)',novosibirsk_tail_%s,bkg_constraint_tail_%s)"%((c,)*5))
+        w.factory("RooNovosibirsk::bkg_%s(gg_mass,peak_%s,width_%s,tail_%s)"%((c,)*4))
+        w.factory("expr::nbkg_%s('nbkg_fit_%s_%s*(1+0.05*bkg_constraint_%s)',nbkg_fit_%s_%s,bkg_constraint_%s)"%((c,)*7))
+        w.factory("expr::sigma_%s('0.02*mHiggs',mHiggs)"%c)
+        w.factory("Gaussian::sig_%s(gg_mass,mHiggs,sigma_%s)"%(c, c))
+        w.factory("expr::nsig_%s('(npbBSM+0.02*bias_%s+0.02*BIAS)*100',npbBSM,bias_%s,BIAS)"%((c,)*3))
+        w.factory("SUM::model_%s(nsig_%s*sig_%s,nbkg_%s*bkg_%s)"%((c,)*5))
+        # bias-test.py expects the RooSimultaneous at the top, so the
+        # constraints go into the pdf of each category
+        w.factory("PROD::model_constr_%s(model_%s,%s)"%(c, c, ','.join(constraints)))
+        models.append("%s=model_constr_%s"%(c, c))
+    w.factory("SIMUL::combPdf(channellist,%s)"%','.join(models))
+
+    mc = r.RooStats.ModelConfig("mconfig", w)
+    mc.SetPdf(w.pdf("combPdf"))
+    mc.SetParametersOfInterest(r.RooArgSet(w.var("npbBSM")))
+    nuis = r.RooArgSet()
+    for name in nps:
+        nuis.add(w.var(name))
+    mc.SetNuisanceParameters(nuis)
+    mc.SetObservables(r.RooArgSet(w.var("gg_mass"), w.cat("channellist")))
+    getattr(w, 'import')(mc)
+    w.writeToFile(path)
+
+def configurations(args):
+    for ntrial, ghost, offset in itertools.product(args.ntrial, (False, True), (False, True)):
+        name = 'n%d%s%s'%(ntrial, '-ghost' if ghost else '', '-offset' if offset else '')
+        yield name, dict(ntrial=ntrial, ghost=ghost, offset=offset)
+
+def run(ws, workdir, name, config, extra):
+    out = os.path.join(workdir, name)
+    cmd = [sys.executable, BIAS_TEST, '--ws', ws, '--mX', '300', '--xsec', '0.5',
+            '--seed', '1', '--ntrial', str(config['ntrial']), '--out', out] + extra
+    if config['ghost']:
+        cmd.append('--ghost')
+    if config['offset']:
+        cmd.append('--offset')
+    t0 = time.time()
+    with open(out+'.log', 'w') as log:
+        subprocess.check_call(cmd, stdout=log, stderr=subprocess.STDOUT)
+    wall = time.time() - t0
+
+    d = resultstore.read_results(resultstore.result_path(out))
+    rec = d['records']
+    # the first trial also carries the job setup (load, edit)
+    per_trial = {}
+    for s in stagetimer.STAGES:
+        if 'wall_'+s in rec.dtype.names:
+            per_trial[s] = float(np.mean(rec['wall_'+s][1:] if len(rec) > 1 else rec['wall_'+s]))
+    return dict(config,
+            wall=wall,
+            import_wall=d.get('import_wall'),
+            setup=float(rec['wall_load'][0] + rec['wall_edit'][0]) if len(rec) else None,
+            nfit=len(rec),
+            fit_time=float(np.mean(rec['fit_time'])) if len(rec) else None,
+            ncall_migrad=float(np.mean(rec['ncall_migrad'])) if len(rec) else None,
+            ncall_minos=float(np.mean(rec['ncall_minos'])) if len(rec) else None,
+            per_trial=per_trial)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, reference):
+    print "%-22s %10s %10s %7s | %10s %10s %7s"%('config', 'fit [s]', 'ref', 'ratio', 'trial [s]', 'ref', 'ratio')
+    for name in sorted(results['configs']):
+        if name not in reference['configs']:
+            continue
+        a, b = results['configs'][name], reference['configs'][name]
+        ta, tb = sum(a['per_trial'].values()), sum(b['per_trial'].values())
+        print "%-22s %10.4f %10.4f %7.2f | %10.4f %10.4f %7.2f"%(name,
+                a['fit_time'], b['fit_time'], a['fit_time']/b['fit_time'],
+                ta, tb, ta/tb)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+            epilog="All other options are passed on to bias-test.py.")
+    parser.add_argument("--out", default="benchmark.json", help="Output JSON file")
+    parser.add_argument("--workdir", default="benchmark", help="Directory for the workspace, logs and result files")
+    parser.add_argument("--ntrial", default="5,20", type=lambda s: map(int, s.split(',')), help="Comma separated numbers of trials to run")
+    parser.add_argument("--ws", help="Benchmark on this workspace instead of the synthetic one")
+    parser.add_argument("--compare", metavar="JSON", help="Compare to the results of an earlier run")
+    args, extra = parser.parse_known_args()
+
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    ws = args.ws
+    if ws is None:
+        ws = os.path.join(args.workdir, WS_NAME)
+        if not os.path.exists(ws):
+            print "Building the synthetic workspace", ws
+            make_workspace(ws)
+
+    results = dict(commit=git_commit(), host=socket.gethostname(), date=time.strftime('%Y-%m-%d %H:%M:%S'),
+            ws=ws, extra_args=extra, configs={})
+    for name, config in configurations(args):
+        print "Running", name
+        results['configs'][name] = res = run(ws, args.workdir, name, config, extra)
+        print "  %.1f s, %.4f s/fit, %.0f migrad calls/fit"%(res['wall'], res['fit_time'], res['ncall_migrad'])
+
+    tmp = args.out + '.tmp.%d'%os.getpid()
+    with open(tmp, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    os.rename(tmp, args.out)
+    print "Wrote", args.out
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -4,12 +4,44 @@ import time
 START_TIME = time.time()
 
 import argparse
-import ROOT as r
-r.gROOT.SetBatch(1)
+import stagetimer
 import sys, os
-import numpy as np
+import itertools
+import collections
 import cPickle
+import multiprocessing
+import numpy as np
+import resultstore
+import fitconfig
+import toybank
+import biasstats
+
+# ROOT is only imported once the arguments and outputs have been checked
+r = None
+IMPORT_WALL = IMPORT_CPU = None
+
+def import_root():
+    ''' Import ROOT (once) and record how long it took '''
+    global r, IMPORT_WALL, IMPORT_CPU
+    if r is not None:
+        return
+    t0, c0 = time.time(), stagetimer.cpu_time()
+    import ROOT
+    ROOT.gROOT.SetBatch(1)
+    r = ROOT
+    IMPORT_WALL, IMPORT_CPU = time.time() - t0, stagetimer.cpu_time() - c0
+
+def create_nll(pdf, ds, offset):
+    ''' An NLL owned by Python, so that it and its copy of the toy are
+        freed as soon as nothing refers to it any more '''
+    nll = pdf.createNLL(ds, r.RooFit.Offset(offset))
+    r.SetOwnership(nll, True)
+    return nll
 
+def save_result(minimizer):
+    res = minimizer.save()
+    r.SetOwnership(res, True)
+    return res
 
 def iterset(rooset):
     itr = rooset.createIterator()
@@ -18,6 +50,29 @@ def iterset(rooset):
         if not x: break
         yield x
 
+def parse_range(s):
+    # "260:450:10" -> [260, 270, ..., 450] (inclusive, like bash {260..450..10})
+    items = map(int, s.split(':'))
+    if len(items) == 1:
+        return items
+    start, stop = items[:2]
+    step = items[2] if len(items) > 2 else 1
+    return range(start, stop+1, step)
+
+def parse_list(s):
+    return map(float, s.split(','))
+
+RETRY_STEPS = ['reinit', 'strategy', 'offset', 'ghost']
+
+def parse_steps(s):
+    steps = s.split(',')
+    for step in steps:
+        if step not in RETRY_STEPS:
+            raise argparse.ArgumentTypeError("unknown retry step %s (choose from %s)"%(step, ', '.join(RETRY_STEPS)))
+        if steps.count(step) > 1:
+            raise argparse.ArgumentTypeError("retry step %s given more than once"%step)
+    return steps
+
 def bias_adj_function(n):
     if n == 0:
         # linear between 260,400, constant above.
@@ -46,266 +101,901 @@ def bias_adj_function(n):
     else:
         raise Exception("Unknown function: %d"%n)
 
+def uses_bias_adj(args):
+    return args.bias_adj is not None or args.bias_adj_function is not None or args.bias_table is not None
+
+def point_bias_adj(args, mass, xs):
+    ''' The bias adjust of a grid point, or None '''
+    if args.bias_table is not None:
+        return float(biasstats.interpolate_bias(args.bias_table, mass, xs))
+    if args.bias_adj_function is not None:
+        return bias_adj_function(args.bias_adj_function)(mass, xs)
+    return args.bias_adj
+
+def category_index(cat, label):
+    cat.setLabel(label)
+    return cat.getIndex()
+
+def dataset_from_arrays(name, obs, cat, masses, indices, wt=None, weights=None):
+    ''' A RooDataSet of (cat, obs) from NumPy arrays of observable values
+        and category indices, weighted by wt if it is given. '''
+    columns = {obs.GetName(): np.asarray(masses, dtype=float),
+               cat.GetName(): np.asarray(indices, dtype=np.int32)}
+    variables = [obs, cat]
+    if wt is not None:
+        columns[wt.GetName()] = np.asarray(weights, dtype=float)
+        variables.append(wt)
+    if hasattr(r.RooDataSet, 'from_numpy'):
+        ds = r.RooDataSet.from_numpy(columns, variables, name=name,
+                weight_name=wt.GetName() if wt is not None else None)
+    else:
+        # no NumPy interface in this ROOT; fill row by row
+        argset = r.RooArgSet(*variables)
+        if wt is not None:
+            ds = r.RooDataSet(name, name, argset, wt.GetName())
+        else:
+            ds = r.RooDataSet(name, name, argset)
+        row = r.RooArgSet(obs, cat)
+        for i in xrange(len(masses)):
+            obs.setVal(masses[i])
+            cat.setIndex(int(indices[i]))
+            if wt is not None:
+                ds.add(row, weights[i])
+            else:
+                ds.add(row)
+    r.SetOwnership(ds, True)
+    ds.SetName(name)
+    return ds
+
+def dataset_arrays(ds, obs, cat):
+    ''' The observable values and category indices of a RooDataSet '''
+    if hasattr(ds, 'to_numpy'):
+        columns = ds.to_numpy()
+        return columns[obs.GetName()], columns[cat.GetName()]
+    masses = np.empty(ds.numEntries())
+    indices = np.empty(ds.numEntries(), dtype=np.int32)
+    for i in xrange(ds.numEntries()):
+        row = ds.get(i)
+        masses[i] = row.getRealValue(obs.GetName())
+        indices[i] = row.getCatIndex(cat.GetName())
+    return masses, indices
+
+def bank_path(path, xs, mass):
+    ''' The toy bank of a point: path itself, or a bank in the directory path '''
+    if os.path.isdir(path):
+        return os.path.join(path, toybank.bank_name(xs, mass))
+    return path
+
+def writable(path):
+    ''' Whether path can be created, or overwritten, by this process '''
+    path = os.path.abspath(path)
+    if os.path.exists(path):
+        return os.access(path, os.W_OK)
+    parent = os.path.dirname(path)
+    while not os.path.exists(parent):
+        parent = os.path.dirname(parent)
+    return os.path.isdir(parent) and os.access(parent, os.W_OK)
+
+def point_trials(args, xs, mass):
+    if args.from_bank:
+        return toybank.ToyBank(bank_path(args.from_bank, xs, mass)).trials(*args.bank_range)
+    return range(args.ntrial)
+
+# the presets that the model options stand for, in the order they are applied
+FLAG_PRESETS = [
+        ('freeze_bias', 'freeze-bias'),
+        ('freeze_ss', 'freeze-ss'),
+        ('free_shape', 'free-shape'),
+        ('freeze_shape', 'freeze-shape'),
+        ('free_norm', 'free-norm'),
+        ]
+
+def fit_config(args):
+    names = ['default'] + [p for flag, p in FLAG_PRESETS if getattr(args, flag)] + (args.preset or [])
+    presets = [fitconfig.load_preset(name) for name in names]
+    if args.poi_min is not None:
+        presets.append(dict(description="POI minimum=%g"%args.poi_min, min=dict(npbBSM=args.poi_min)))
+    return fitconfig.FitConfig(presets)
+
+class ToyFitter(object):
+    ''' Holds the configured workspace so that it can be reused for
+        any number of (mX, xsec) points. '''
+
+    SNAPSHOT = "bias_test_initial"
+    GEN_SNAPSHOT = "bias_test_generate"
+    FIT_SNAPSHOT = "bias_test_fit_start"
+    REINIT_SNAPSHOT = "bias_test_reinit"
+    PROFILE_SNAPSHOT = "bias_test_profile_start"
+
+    def __init__(self, args):
+        self.args = args
+        # not reset until after the first trial, which is charged with the setup
+        self.timer = stagetimer.StageTimer()
+
+        self.f = r.TFile(args.ws)
+        w = self.w = self.f.Get("combination")
+        mc = self.mc = w.obj("mconfig")
+        self.timer.lap('load')
+
+        self.pdf = mc.GetPdf()
+
+        if uses_bias_adj(args):
+            w.factory("expr::npbBSM_adj('npbBSM+bias_adj',npbBSM,bias_adj[0])")
+            w.factory("EDIT::pdf_alt(%s,npbBSM=npbBSM_adj)"%self.pdf.GetName())
+            self.pdf = w.obj("pdf_alt")
+
+        self.obs = w.obj("gg_mass")
+        self.cat = w.obj("channellist")
+        if args.binned:
+            # binning of the generated toys, and of the Asimov dataset
+            self.obs.setBins(args.binned)
+
+        self.mX = w.obj("mHiggs")
+        self.xsec = w.obj("npbBSM")
+
+        # set NPs to zero
+        self.nps = list(iterset(mc.GetNuisanceParameters()))
+        for v in self.nps:
+            print "setting %s=0"%v.GetName()
+            v.setVal(0)
+
+        # all parameter lookups happen here, once
+        self.config = fit_config(args)
+        self.config.resolve(w)
+        self.config.apply()
+
+        if args.ghost or 'ghost' in args.retry:
+            self.wt = w.factory("wt[1.0]")
+            self.ghosts = self.ghost_template()
+
+        # everything above is common to all grid points; remember it so
+        # each point starts from the same state.
+        w.saveSnapshot(self.SNAPSHOT, w.allVars())
+        self.timer.lap('edit')
+
+        self.bias_adj = None
+        self.point = None
+        self.start_errors = None
+        self.nll = None
+        self.bank = None
+        self.nll_kind = None
+        self.last_result = None
+        self.last_nll = None
+        self.canvas = None
+
+    def set_point(self, mass, xs, seed):
+        if self.point == (mass, xs):
+            return
+        self.point = (mass, xs)
+
+        w = self.w
+        w.loadSnapshot(self.SNAPSHOT)
+
+        args = self.args
+        self.bias_adj = point_bias_adj(args, mass, xs)
+        if self.bias_adj is not None:
+            print "Applying bias adjust of:", self.bias_adj
+            w.obj("bias_adj").setVal(0)
+
+        print "setting mX=%g"%mass
+        self.mX.setVal(mass)
+        print "injecting xsec=%g"%xs
+        self.xsec.setVal(xs)
+        self.expected_events = self.pdf.expectedEvents(r.RooArgSet(self.cat,self.obs))
+        w.saveSnapshot(self.GEN_SNAPSHOT, w.allVars())
+
+        if self.bias_adj is not None:
+            w.obj("bias_adj").setVal(self.bias_adj)
+        self.xsec.setVal(1)
+        self.xsec.setConstant(False)
+        w.saveSnapshot(self.FIT_SNAPSHOT, w.allVars())
+        for v in self.nps:
+            v.setVal(0)
+        self.xsec.setVal(0.5)
+        w.saveSnapshot(self.REINIT_SNAPSHOT, w.allVars())
+
+        self.bank = None
+        if args.from_bank:
+            self.bank = toybank.ToyBank(bank_path(args.from_bank, xs, mass))
+            header = self.bank.header
+            if (header['mX'], header['xsec']) != (mass, xs):
+                raise ValueError("%s holds toys for mX=%g xsec=%g"%(self.bank.path, header['mX'], header['xsec']))
+            for label, index in header['labels'].iteritems():
+                if category_index(self.cat, str(label)) != index:
+                    raise ValueError("%s: category %s has another index in this workspace"%(self.bank.path, label))
+
+        self.start_errors = None
+        if args.start_errors:
+            # take the initial step sizes of all fits at this point from a
+            # reference fit; the same in every process, so the results do
+            # not depend on --workers.
+            if args.start_errors == 'asimov':
+                print "Reference fit to the Asimov dataset"
+                ds = self.asimov()
+            else:
+                print "Reference fit to trial 0"
+                itrial, ds = next(self.toys([0], seed))
+            self.fit(ds)
+            self.start_errors = [(self.w.var(v.GetName()), v.getError()) for v in iterset(self.last_result.floatParsFinal())]
+            # --fast-fit: build the reused NLL from a real toy
+            self.nll = None
+
+    def ghost_template(self):
+        ''' The weighted dataset of ghost points, built once per job '''
+        args = self.args
+        masses = []
+        xdummy = args.ghost_start
+        while xdummy < self.obs.getMax():
+            masses.append(xdummy)
+            xdummy += args.ghost_interval
+        labels = ['bb', 'bj']
+        masses = np.repeat(masses, len(labels))
+        indices = np.tile([category_index(self.cat, l) for l in labels], len(masses)//len(labels))
+        weights = np.full(len(masses), args.ghost_weight)
+        ds = dataset_from_arrays("ghosts", self.obs, self.cat, masses, indices, self.wt, weights)
+        print "%d ghost points"%ds.numEntries()
+        return ds
+
+    def add_ghosts(self, ds, name):
+        ''' A copy of the toy ds with the ghost points '''
+        # the ghost points go in first, then the toy is appended in one
+        # go; RooFit reads the weight of the toy's events from the wt
+        # column.
+        ds.addColumn(self.wt)
+        ghosted = r.RooDataSet(self.ghosts, name)
+        r.SetOwnership(ghosted, True)
+        ghosted.append(ds)
+        return ghosted
+
+    def asimov(self):
+        ''' The expected dataset for the current point '''
+        self.w.loadSnapshot(self.GEN_SNAPSHOT)
+        ds = r.RooStats.AsymptoticCalculator.GenerateAsimovData(self.pdf, r.RooArgSet(self.obs))
+        r.SetOwnership(ds, True)
+        return ds
+
+    def generate(self, itrial, seed):
+        args = self.args
+        pdf, obs, cat = self.pdf, self.obs, self.cat
+        self.w.loadSnapshot(self.GEN_SNAPSHOT)
+        # every trial has its own seed, so a toy does not depend on
+        # which other trials were generated in the same process.
+        tseed = trial_seed(seed, itrial)
+        r.RooRandom.randomGenerator().SetSeed(tseed)
+        if args.poisson:
+            nevt = np.random.RandomState(tseed+100).poisson(self.expected_events)
+        else:
+            # what generate() does without an event count
+            nevt = int(self.expected_events + 0.5)
+        if args.binned:
+            return pdf.generateBinned(r.RooArgSet(cat, obs), nevt)
+        elif args.poisson:
+            return pdf.generate(r.RooArgSet(cat, obs), nevt)
+        else:
+            return pdf.generate(r.RooArgSet(cat, obs))
+
+    def bank_toy(self, itrial):
+        ''' Toy itrial of the --from-bank toys of the current point '''
+        name = "ds_%03d"%itrial
+        indices, masses = self.bank.toy(itrial)
+        ds = dataset_from_arrays(name, self.obs, self.cat, masses, indices)
+        if self.args.binned:
+            return r.RooDataHist(name, name, r.RooArgSet(self.cat, self.obs), ds)
+        return ds
+
+    def write_bank(self, path, mass, xs, seed, trials):
+        ''' Generate the toys of a point into a toy bank '''
+        self.set_point(mass, xs, seed)
+        labels = dict((l, category_index(self.cat, l)) for l in ('bb', 'bj'))
+        writer = toybank.BankWriter(path, self.obs.GetName(), self.cat.GetName(),
+                mX=mass, xsec=xs, seed=seed, poisson=self.args.poisson,
+                expected_events=self.expected_events, labels=labels, argv=sys.argv)
+        for itrial, ds in self.toys(trials, seed):
+            masses, indices = dataset_arrays(ds, self.obs, self.cat)
+            writer.append(indices, masses)
+        writer.close()
+        print "Wrote %d toys to %s"%(len(trials), path)
+
+    def toys(self, trials, seed):
+        ''' Generate (or read from the bank) the toys for the current point
+            one at a time, so that only one toy has to be held in memory. '''
+        args = self.args
+
+        for itrial in trials:
+            self.timer.mark()
+            if self.bank is not None:
+                ds = self.bank_toy(itrial)
+            else:
+                ds = self.generate(itrial, seed)
+            r.SetOwnership(ds, True)
+            ds.SetName("ds_%03d"%itrial)
+            ds.Print()
+            self.timer.lap('generate')
+            if args.ghost:
+                ds = self.add_ghosts(ds, "ds_%03d"%itrial)
+                self.timer.lap('ghost')
+            ds.Print()
+            yield itrial, ds
+            del ds
+
+    def fit(self, ds, reinit=False, strategy=None, offset=None):
+        ''' Fit ds; the keyword arguments override --reinit, the Minuit
+            strategy and --offset. '''
+        args = self.args
+        w, pdf, xsec = self.w, self.pdf, self.xsec
+        if offset is None:
+            offset = args.offset
+
+        # start every fit from the same point rather than from wherever
+        # the previous toy's fit ended up.
+        if args.reinit or reinit:
+            print "Re-initializing NP and POI values."
+            w.loadSnapshot(self.REINIT_SNAPSHOT)
+        else:
+            w.loadSnapshot(self.FIT_SNAPSHOT)
+        if self.start_errors:
+            for v, err in self.start_errors:
+                v.setError(err)
+        t0 = time.time()
+        timer = self.timer
+        timer.mark()
+        # a retry may need an NLL of another kind than the reused one
+        kind = (ds.ClassName(), ds.isWeighted(), offset)
+        if not args.fast_fit or (self.nll is not None and kind != self.nll_kind):
+            nll = create_nll(pdf, ds, offset)
+        elif self.nll is None:
+            nll = self.nll = create_nll(pdf, ds, offset)
+            self.nll_kind = kind
+        else:
+            # reuse the NLL graph and only swap in the new toy; the toy
+            # outlives the fit, so there is no need to clone it.
+            nll = self.nll
+            if not nll.setData(ds, False):
+                # RooFit refused the toy and kept the previous one
+                print "Warning: could not swap the toy into the NLL, building a new one"
+                nll = self.nll = create_nll(pdf, ds, offset)
+
+        # migrad, hesse, minos; -1 if not run
+        fit_statuses = [-1, -1, -1]
+        minimizer = r.RooMinuit(nll)
+        if strategy is not None:
+            minimizer.setStrategy(strategy)
+        timer.lap('nll')
+        ncall = r.gMinuit.fNfcn
+        minimizer.migrad()
+        ncall_migrad = r.gMinuit.fNfcn - ncall
+        res = save_result(minimizer)
+        fit_statuses[0] = res.status()
+        timer.lap('migrad')
+        if args.hesse:
+            minimizer.hesse()
+            res = save_result(minimizer)
+            fit_statuses[1] = res.status()
+            timer.lap('hesse')
+        ncall_minos = 0
+        if not args.skip_minos:
+            ncall = r.gMinuit.fNfcn
+            minimizer.minos()
+            ncall_minos = r.gMinuit.fNfcn - ncall
+            res = save_result(minimizer)
+            fit_statuses[2] = res.status()
+            timer.lap('minos')
+        self.last_result = res
+        self.last_nll = nll
+
+        vals, errs_lo, errs_hi = self.config.read()
+        return dict(
+                statuses=tuple(fit_statuses),
+                nll_invalid=res.numInvalidNLL(),
+                ncall_migrad=ncall_migrad,
+                ncall_minos=ncall_minos,
+                fit_time=time.time() - t0,
+                poi=xsec.getVal(),
+                vals=vals,
+                errs_lo=errs_lo,
+                errs_hi=errs_hi,
+                )
+
+    def profile(self):
+        ''' Scan the POI over --profile-poi points around the minimum of the
+            last fit, --profile-width times its error to either side. The
+            two branches run outwards from the minimum, and every point
+            starts from the minimum of its neighbour. A point whose POI was
+            not held at its value gets status -2 and no delta NLL. '''
+        args = self.args
+        n = args.profile_poi
+        out = dict(profile_poi=np.full(n, np.nan), profile_dnll=np.full(n, np.nan),
+                profile_status=-np.ones(n, dtype=int), ncall_profile=0)
+        xsec, nll = self.xsec, self.last_nll
+        err = xsec.getError()
+        if not err > 0:
+            return out
+        self.timer.mark()
+        offsets = np.linspace(-args.profile_width, args.profile_width, n)
+        grid = np.clip(xsec.getVal() + err*offsets, xsec.getMin(), xsec.getMax())
+        out['profile_poi'] = grid
+        nll_min = nll.getVal()
+        self.w.saveSnapshot(self.PROFILE_SNAPSHOT, self.w.allVars())
+
+        minimizer = r.RooMinuit(nll)
+        minimizer.setPrintLevel(-1)
+        ncall = r.gMinuit.fNfcn
+        for branch in (np.where(offsets <= 0)[0][::-1], np.where(offsets > 0)[0]):
+            # the snapshot also restores the POI's constant flag
+            self.w.loadSnapshot(self.PROFILE_SNAPSHOT)
+            xsec.setConstant(True)
+            for i in branch:
+                xsec.setVal(grid[i])
+                out['profile_status'][i] = minimizer.migrad()
+                if xsec.getVal() != grid[i]:
+                    out['profile_status'][i] = -2
+                    continue
+                out['profile_dnll'][i] = nll.getVal() - nll_min
+        xsec.setConstant(False)
+        out['ncall_profile'] = r.gMinuit.fNfcn - ncall
+        self.timer.lap('profile')
+        return out
+
+    def recover(self, ds, result):
+        ''' Refit a failed toy with the --retry steps, each on top of the
+            ones before, until the fit succeeds. Returns the last fit's
+            result, with the number of steps taken as recovery and the
+            cost of all attempts, and the dataset it was fitted to. '''
+        opts = {}
+        total = dict((k, result[k]) for k in ('ncall_migrad', 'ncall_minos', 'fit_time'))
+        for istep, step in enumerate(self.args.retry):
+            print "Fit failed with statuses %s, retrying with %s"%(result['statuses'], step)
+            if step == 'reinit':
+                opts['reinit'] = True
+            elif step == 'strategy':
+                opts['strategy'] = 2
+            elif step == 'offset':
+                opts['offset'] = True
+            elif step == 'ghost':
+                ds = self.add_ghosts(ds, ds.GetName()+"_ghost")
+            result = self.fit(ds, **opts)
+            for k in total:
+                total[k] += result[k]
+            result['recovery'] = istep + 1
+            if max(result['statuses']) <= 0:
+                break
+        result.update(total)
+        return result, ds
+
+    def plot(self, ds, fname):
+        w, pdf, cat = self.w, self.pdf, self.cat
+        if self.canvas is None:
+            self.canvas = r.TCanvas("c1","c1", 800, 600)
+            self.canvas.cd()
+            self.pad1 = r.TPad("pad1","pad1",0,0.5,1,1)
+            self.pad1.Draw()
+            self.canvas.cd()
+            self.pad2 = r.TPad("pad2","pad2",0,0,1,0.5)
+            self.pad2.Draw()
+        frame1 = w.obj("gg_mass").frame()
+        ds.plotOn(frame1, r.RooFit.Cut("channellist==channellist::bj"))
+        pdf.plotOn(frame1, r.RooFit.Slice(cat, "bj"), r.RooFit.ProjWData(r.RooArgSet(cat), ds), r.RooFit.LineColor(r.kRed))
+        self.pad1.cd()
+        frame1.SetTitle(";;")
+        frame1.GetXaxis().SetLabelSize(0.07)
+        frame1.Draw()
+        frame2 = w.obj("gg_mass").frame()
+        ds.plotOn(frame2, r.RooFit.Cut("channellist==channellist::bb"))
+        pdf.plotOn(frame2, r.RooFit.Slice(cat, "bb"), r.RooFit.ProjWData(r.RooArgSet(cat), ds), r.RooFit.LineColor(r.kRed))
+        self.pad2.cd()
+        frame2.SetTitle(";;")
+        frame2.GetXaxis().SetLabelSize(0.07)
+        frame2.Draw()
+        self.canvas.Update()
+        self.canvas.SaveAs(fname)
+
+    def datasets(self, trials, seed):
+        ''' The toys for the given trials, or with --asimov the Asimov
+            dataset (which is binned in gg_mass) as the only trial. '''
+        if not self.args.asimov:
+            for itrial, ds in self.toys(trials, seed):
+                yield itrial, ds
+            return
+        self.timer.mark()
+        ds = self.asimov()
+        ds.SetName("asimov")
+        ds.Print()
+        self.timer.lap('generate')
+        yield 0, ds
+
+    def want_plot(self, itrial, result):
+        args = self.args
+        if not args.plots or itrial % args.plots_every:
+            return False
+        bad = max(result['statuses']) > 0
+        if args.plots_failed:
+            return bad
+        return not (args.only_good and bad)
+
+    def run_trials(self, mass, xs, seed, trials, out):
+        self.set_point(mass, xs, seed)
+        toys = self.datasets(trials, seed)
+        while True:
+            t0 = time.time()
+            try:
+                itrial, ds = next(toys)
+            except StopIteration:
+                break
+            result = self.fit(ds)
+            if self.args.retry and max(result['statuses']) > 0:
+                result, ds = self.recover(ds, result)
+            else:
+                result['recovery'] = 0
+            result['trial'] = itrial
+            if self.args.profile_poi:
+                result.update(self.profile())
+            if self.want_plot(itrial, result):
+                # drawn by the PlotRenderer; only the serialization of the
+                # toy and of the fitted values is charged to the fit loop.
+                self.timer.mark()
+                values = [(v.GetName(), v.getVal()) for v in iterset(self.last_result.floatParsFinal())]
+                result['plot'] = (out+".%d.pdf"%itrial, cPickle.dumps(ds, cPickle.HIGHEST_PROTOCOL), values)
+                self.timer.lap('plot')
+            # done with this toy, free it before generating the next one
+            del ds
+            result['elapsed'] = time.time() - t0
+            result.update(self.timer.record())
+            result['peak_rss'] = stagetimer.peak_rss()
+            self.timer.reset()
+            yield result
+
+# per-process fitter used by the --workers pool
+_fitter = None
+
+def init_worker(args):
+    global _fitter
+    import_root()
+    # WARNING ERROR FATAL
+    r.RooMsgService.instance().setGlobalKillBelow(r.RooFit.ERROR)
+    _fitter = ToyFitter(args)
+
+def run_task(task):
+    return list(_fitter.run_trials(*task))
+
+# per-process fitter used to draw the plots of the PlotRenderer
+_renderer = None
+
+def init_renderer(args):
+    global _renderer
+    import_root()
+    r.RooMsgService.instance().setGlobalKillBelow(r.RooFit.ERROR)
+    # the reference fits of --start-errors are not needed for drawing
+    args = argparse.Namespace(**vars(args))
+    args.start_errors = None
+    _renderer = ToyFitter(args)
+
+def render_task(task):
+    mass, xs, seed, fname, data, values = task
+    _renderer.set_point(mass, xs, seed)
+    _renderer.w.loadSnapshot(_renderer.FIT_SNAPSHOT)
+    for name, val in values:
+        _renderer.w.var(name).setVal(val)
+    _renderer.plot(cPickle.loads(data), fname)
+
+class PlotRenderer(object):
+    ''' Draws the --plots in processes of their own, so that the fits do
+        not wait for the projections and the PDF output. '''
+
+    def __init__(self, args):
+        self.pool = multiprocessing.Pool(args.plot_workers, init_renderer, (args,))
+        self.pending = collections.deque()
+        # bound the number of toys waiting to be drawn
+        self.limit = 4*args.plot_workers
+        self.nplot = 0
+        self.nfail = 0
+
+    def submit(self, mass, xs, seed, plot):
+        while len(self.pending) >= self.limit:
+            self.wait_one()
+        fname, data, values = plot
+        self.pending.append(self.pool.apply_async(render_task, ((mass, xs, seed, fname, data, values),)))
+
+    def wait_one(self):
+        try:
+            self.pending.popleft().get()
+            self.nplot += 1
+        except Exception as e:
+            print "Warning: plot failed: %s"%e
+            self.nfail += 1
+
+    def close(self):
+        while self.pending:
+            self.wait_one()
+        self.pool.close()
+        self.pool.join()
+        print "Drew %d plots (%d failed)"%(self.nplot, self.nfail)
+
+def trial_seed(seed, itrial):
+    return (seed*100003 + itrial) % 2**31
+
+# number of --retry steps a fit needed (0 for none)
+EXTRA_FIELDS = [('recovery', '<i1')] + stagetimer.record_fields()
+
+RECORD_FIELDS = ['trial', 'poi', 'vals', 'errs_lo', 'errs_hi', 'statuses', 'nll_invalid',
+        'ncall_migrad', 'ncall_minos', 'fit_time', 'peak_rss'] + [f for f,t in EXTRA_FIELDS]
+
+def profile_fields(n):
+    ''' Record fields of a --profile-poi scan over n points '''
+    return [('profile_poi', '<f4', (n,)), ('profile_dnll', '<f4', (n,)),
+            ('profile_status', '<i1', (n,)), ('ncall_profile', '<i4')]
+
+class PointOutput(object):
+    ''' Collects the trial results of one grid point and writes them out. '''
+
+    def __init__(self, args, keys, mass, xs, seed, out, ntrial, setup_time=0):
+        self.args = args
+        # core-seconds spent on this point, independent of --workers
+        self.runtime = setup_time
+        self.status_skip = 0
+        # good fits by the number of retry steps they took
+        self.recovered = [0]*(len(args.retry)+1)
+        self.nfit = 0
+        self.ncall_migrad = 0
+        self.fit_time = 0
+        self.extra_fields = list(EXTRA_FIELDS)
+        self.fields = list(RECORD_FIELDS)
+        if args.profile_poi:
+            self.extra_fields += profile_fields(args.profile_poi)
+            self.fields += [f[0] for f in profile_fields(args.profile_poi)]
+        self.writer = None
+        if out:
+            self.writer = resultstore.ResultWriter(
+                    resultstore.result_path(out),
+                    resultstore.result_dtype(len(keys), self.extra_fields),
+                    manifest=args.sharded,
+                    keys=keys,
+                    mX=mass,
+                    xsec=xs,
+                    seed=seed,
+                    ntrial=ntrial,
+                    argv=sys.argv,
+                    jobid=os.environ.get('SLURM_JOBID', os.environ.get('SCAN_JOBID')),
+                    import_wall=IMPORT_WALL,
+                    import_cpu=IMPORT_CPU,
+                    asimov=args.asimov,
+                    binned=args.binned,
+                    retry=args.retry,
+                    bank=args.from_bank,
+                    bank_range=args.bank_range,
+                    bias_adj=point_bias_adj(args, mass, xs),
+                    bias_adj_table=args.bias_adj_table,
+                    )
+        # the time spent writing a record is stored with the next one
+        self.output_time = (0., 0.)
+
+    def add(self, result):
+        self.runtime += result['elapsed']
+        self.nfit += 1
+        self.ncall_migrad += result['ncall_migrad']
+        self.fit_time += result['fit_time']
+
+        if max(result['statuses']) <= 0:
+            self.recovered[result['recovery']] += 1
+        elif self.args.only_good:
+            self.status_skip += 1
+            if self.writer:
+                self.writer.skip()
+            return
+
+        if self.writer:
+            w0, c0 = time.time(), stagetimer.cpu_time()
+            record = dict((k, result[k]) for k in self.fields)
+            record['runtime'] = self.runtime
+            record['wall_output'], record['cpu_output'] = self.output_time
+            self.writer.append(record)
+            self.output_time = (time.time() - w0, stagetimer.cpu_time() - c0)
+
+    def close(self):
+        if self.writer:
+            self.writer.close(self.runtime)
+        print "Skipped %d trials with bad status."%self.status_skip
+        if self.args.retry:
+            print "Recovered %d fits (%s)"%(sum(self.recovered[1:]),
+                    ', '.join('%s: %d'%(step, n) for step, n in zip(self.args.retry, self.recovered[1:])))
+        if self.nfit:
+            print "Fits (%s): %.1f migrad calls/fit, %.3f s/fit"%(
+                    "fast" if self.args.fast_fit else "standard",
+                    1.*self.ncall_migrad/self.nfit, self.fit_time/self.nfit)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--ws", required=True, help="The workspace file")
     parser.add_argument("--seed", type=int, default=1, help="The random seed for RooFit")
-    parser.add_argument("--out", help="Output filename")
+    parser.add_argument("--out", help="Output filename (output directory in scan mode)")
     parser.add_argument("--ntrial", type=int, default=10, help="The number of trials generate")
     parser.add_argument("--mX", type=int, default=300, help="The resonance mass [GeV]")
     parser.add_argument("--xsec", type=float, default=1.0, help="The signal cross section to inject [pb]")
+    parser.add_argument("--sharded", action="store_true", help="--out is a scan directory: write into its shard for the point, x<xsec>/m<mX>/, and enter the job into the shard's manifest")
+    parser.add_argument("--job", type=int, help="Job index in the file name of a --sharded single-point run (default: the seed)")
+    parser.add_argument("--scan-mX", metavar="MIN:MAX:STEP", type=parse_range, help="Scan a range of resonance masses in one job")
+    parser.add_argument("--scan-xsec", metavar="XS1,XS2,...", type=parse_list, help="Scan a list of injected cross sections in one job")
+    parser.add_argument("--generate-bank", metavar="PATH", help="Only generate the toys and write them to a toy bank (a directory of banks in scan mode)")
+    parser.add_argument("--from-bank", metavar="PATH", help="Fit the toys of a toy bank (a directory of banks in scan mode) instead of generating them")
+    parser.add_argument("--bank-range", metavar="START:STOP", type=toybank.parse_slice, default=(None, None), help="Only fit these toys of the bank")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes to fit trials in")
     parser.add_argument("--poi-min", type=float, help="Minimum POI value")
     parser.add_argument("--freeze-bias", action="store_true", help="Fix the BIAS NP at zero")
     parser.add_argument("--freeze-ss", action="store_true", help="Fix the spurious signal NPs at zero")
     parser.add_argument("--free-shape", action="store_true", help="Use free-floating shape params")
     parser.add_argument("--freeze-shape", action="store_true", help="Fix the shape params to constant values")
     parser.add_argument("--free-norm", action="store_true", help="Use free-floating norm params")
+    parser.add_argument("--preset", metavar="NAME|FILE", action="append", help="Apply a fit configuration preset from presets/ or a file, after the ones selected by the options above (repeatable)")
     parser.add_argument("--bias-adj", type=float, help="Apply a bias adjust offset")
     parser.add_argument("--bias-adj-function", type=int, help="Apply a parametric bias adjust function")
+    parser.add_argument("--bias-adj-table", metavar="FILE", help="Apply the bias adjust interpolated from a table written by plot.py --export-bias-table")
     parser.add_argument("--poisson", action="store_true", help="Randomize number of generated events by poisson sampling.")
     parser.add_argument("--reinit", action="store_true", help="Reinitialize NPs and POI before fits.")
     parser.add_argument("--offset", action="store_true", help="Use offset option in createNLL")
+    parser.add_argument("--fast-fit", action="store_true", help="Build the NLL once and swap in each toy with setData. The reused NLL keeps some state of the toys fitted before in the same process (e.g. the --offset), so with --workers > 1 the results are equivalent but not bit-identical between runs")
+    parser.add_argument("--binned", metavar="NBINS", type=int, help="Generate the toys as binned datasets with NBINS bins in gg_mass and fit a binned likelihood")
+    parser.add_argument("--asimov", action="store_true", help="Fit only the Asimov dataset of every point: a quick estimate of the bias and of the error of a single toy fit")
+    parser.add_argument("--start-errors", choices=["first", "asimov"], help="Start each fit with the parameter errors of a fit to trial 0 or to the Asimov dataset")
+    parser.add_argument("--retry", metavar="STEP,...", type=parse_steps, default=[], help="Refit failed toys, adding these steps one after the other until the fit succeeds: %s"%', '.join(RETRY_STEPS))
+    parser.add_argument("--profile-poi", metavar="N", type=int, help="After each fit, profile the likelihood in npbBSM at N points and store the delta NLL curve; with --workers, the profiles of different toys run in parallel")
+    parser.add_argument("--profile-width", metavar="W", type=float, default=3., help="Range of the --profile-poi scan around the best fit, in units of the fitted npbBSM error")
     parser.add_argument("--only-good", action="store_true", help="Only write out fits that had 0/0 status.")
     parser.add_argument("--skip-minos", action="store_true", help="Do not run minos, only migrad")
     parser.add_argument("--hesse", action="store_true", help="Run Hesse after Migrad")
     parser.add_argument("--plots", action="store_true", help="Save plots of pseudoexperiments/fits")
+    parser.add_argument("--plots-every", metavar="K", type=int, default=1, help="Only plot every K-th trial")
+    parser.add_argument("--plots-failed", action="store_true", help="Only plot fits with a bad status (even with --only-good)")
+    parser.add_argument("--plot-workers", type=int, default=1, help="Number of processes to draw the plots in")
     parser.add_argument("--ghost", action="store_true", help="Add ghost datapoints to prevent weird fits.")
     parser.add_argument("--ghost-start", type=float, default=255, help="Lowest m_jjyy mass point to add ghost events at")
     parser.add_argument("--ghost-interval", type=float, default=2.0, help="Spacing between ghost events")
     parser.add_argument("--ghost-weight", type=float, default=1e-9, help="Weight for ghost events")
+    parser.add_argument("--dry-run", action="store_true", help="Check the arguments and print what would be run, without loading ROOT")
     args = parser.parse_args()
 
-    r.RooRandom.randomGenerator().SetSeed(args.seed)
-    np.random.seed(args.seed+100)
+    scan = args.scan_mX is not None or args.scan_xsec is not None
+    if args.plots and not args.out:
+        parser.error("--plots requires --out")
+    if args.sharded and not args.out:
+        parser.error("--sharded requires --out")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.plots_every < 1 or args.plot_workers < 1:
+        parser.error("--plots-every and --plot-workers must be at least 1")
+    if args.profile_poi is not None and args.profile_poi < 2:
+        parser.error("--profile-poi needs at least two points")
+    if not args.profile_width > 0:
+        parser.error("--profile-width must be positive")
+    if args.binned is not None and args.binned < 1:
+        parser.error("--binned needs at least one bin")
+    if args.binned and args.ghost:
+        parser.error("--ghost cannot be used with binned toys")
+    if 'ghost' in args.retry and (args.ghost or args.binned or args.asimov):
+        parser.error("the ghost retry step needs unbinned toys without --ghost")
+    if args.generate_bank and (args.ghost or args.binned or args.asimov or args.from_bank):
+        parser.error("--generate-bank writes unbinned toys; --ghost, --binned, --asimov and --from-bank apply when fitting them")
+    if args.asimov and args.from_bank:
+        parser.error("--asimov cannot be combined with --from-bank")
+    if args.asimov:
+        if args.ghost or args.poisson:
+            parser.error("--asimov cannot be combined with --ghost or --poisson")
+        # the Asimov dataset is the same for every seed
+        args.ntrial = 1
+    if sum(x is not None for x in (args.bias_adj, args.bias_adj_function, args.bias_adj_table)) > 1:
+        parser.error("use only one of --bias-adj, --bias-adj-function and --bias-adj-table")
+    # read once here; the workers get it with the arguments
+    args.bias_table = biasstats.read_bias_table(args.bias_adj_table) if args.bias_adj_table else None
 
-    # WARNING ERROR FATAL
-    r.RooMsgService.instance().setGlobalKillBelow(r.RooFit.ERROR)
+    if not scan:
+        out = args.out
+        if args.sharded:
+            out = resultstore.shard_out(args.out, args.xsec, args.mX, args.job if args.job is not None else args.seed)
+        points = [(args.mX, args.xsec, args.seed, out)]
+    else:
+        # each grid point gets the same seed and output name that the
+        # equivalent single-point job in submit_example.sh would use,
+        # with --seed playing the role of the job index.
+        masses = args.scan_mX if args.scan_mX is not None else [args.mX]
+        xsecs = args.scan_xsec if args.scan_xsec is not None else [args.xsec]
+        points = []
+        for xs in xsecs:
+            for mass in masses:
+                out = None
+                if args.sharded:
+                    out = resultstore.shard_out(args.out, xs, mass, args.seed)
+                elif args.out:
+                    out = os.path.join(args.out, "fits-x%s-m%d-%d"%(xs, mass, args.seed))
+                points.append((mass, xs, args.seed+mass, out))
 
-    f = r.TFile(args.ws)
-    w = f.Get("combination")
-    mc = w.obj("mconfig")
-
-    pdf = mc.GetPdf()
-
-    if args.bias_adj is not None or args.bias_adj_function is not None:
-        if args.bias_adj_function is not None:
-            args.bias_adj = bias_adj_function(args.bias_adj_function)(args.mX, args.xsec)
-        print "Applying bias adjust of:", args.bias_adj
-        w.factory("expr::npbBSM_adj('npbBSM+bias_adj',npbBSM,bias_adj[0])")
-        w.factory("EDIT::pdf_alt(%s,npbBSM=npbBSM_adj)"%pdf.GetName())
-        w.obj("bias_adj").setVal(args.bias_adj)
-        pdf = w.obj("pdf_alt")
-
-    obs = w.obj("gg_mass")
-    cat = w.obj("channellist")
-
-    mX = w.obj("mHiggs")
-    xsec = w.obj("npbBSM")
-
-    # set NPs to zero
-    for v in iterset(mc.GetNuisanceParameters()):
-        print "setting %s=0"%v.GetName()
-        v.setVal(0)
-
-    if args.freeze_bias:
-        print "fixing BIAS=0"
-        w.obj("BIAS").setVal(0)
-        w.obj("BIAS").setConstant(True)
-    if args.freeze_ss:
-        print "fixing SS=0"
-        w.obj("bias_bb").setVal(0)
-        w.obj("bias_bb").setConstant(True)
-        w.obj("bias_bj").setVal(0)
-        w.obj("bias_bj").setConstant(True)
-    if args.poi_min is not None:
-        print "Setting POI minimum=%g"%args.poi_min
-        w.obj("npbBSM").setMin(args.poi_min)
-        w.obj("npbBSM").Print()
-
-    if args.free_shape or args.freeze_shape:
-        if args.free_shape:
-            print "setting shape parameters to free"
-            w.obj("novosibirsk_peak_bj").setConstant(False)
-            w.obj("novosibirsk_peak_bb").setConstant(False)
-            w.obj("novosibirsk_tail_bj").setConstant(False)
-            w.obj("novosibirsk_tail_bb").setConstant(False)
-            w.obj("novosibirsk_width_bj").setConstant(False)
-            w.obj("novosibirsk_width_bb").setConstant(False)
-        else:
-            print "Fixing shape parameters to constant"
-        w.obj("bkg_constraint_shape_bj").setConstant(True)
-        w.obj("bkg_constraint_shape_bj").setVal(0)
-        w.obj("bkg_constraint_shape_bb").setConstant(True)
-        w.obj("bkg_constraint_shape_bb").setVal(0)
-        w.obj("bkg_constraint_tail_bj").setConstant(True)
-        w.obj("bkg_constraint_tail_bj").setVal(0)
-        w.obj("bkg_constraint_tail_bb").setConstant(True)
-        w.obj("bkg_constraint_tail_bb").setVal(0)
-        w.obj("bkg_constraint_width_bj").setConstant(True)
-        w.obj("bkg_constraint_width_bj").setVal(0)
-        w.obj("bkg_constraint_width_bb").setConstant(True)
-        w.obj("bkg_constraint_width_bb").setVal(0)
-
-    if args.free_norm:
-        w.obj("bkg_constraint_bj").setConstant(True)
-        w.obj("bkg_constraint_bj").setVal(0)
-        w.obj("bkg_constraint_bb").setConstant(True)
-        w.obj("bkg_constraint_bb").setVal(0)
-        w.obj("nbkg_fit_bj_bj").setConstant(False)
-        w.obj("nbkg_fit_bb_bb").setConstant(False)
-
-    print "setting mX=%g"%args.mX
-    mX.setVal(args.mX)
-    print "fixing xsec=%g"%args.xsec
-    xsec.setVal(args.xsec)
-    xsec.setConstant(True)
-
-    # generate datasets
-    datasets = []
-    expected_events = pdf.expectedEvents(r.RooArgSet(cat,obs))
-    if args.bias_adj is not None:
-        w.obj("bias_adj").setVal(0)
-    for itrial in xrange(args.ntrial):
-        if args.poisson:
-            ds = pdf.generate(r.RooArgSet(cat, obs), np.random.poisson(expected_events))
-        else:
-            ds = pdf.generate(r.RooArgSet(cat, obs))
-        ds.SetName("ds_%03d"%itrial)
-        ds.Print()
-        if args.ghost:
-            wt = w.factory("wt[1.0]")
-            ds.addColumn(wt)
+    # everything that can go wrong without ROOT is checked before loading it
+    if not os.path.isfile(args.ws):
+        parser.error("no workspace file %s"%args.ws)
+    try:
+        fit_config(args)
+    except (IOError, ValueError) as e:
+        parser.error("bad fit configuration: %s"%e)
+    outputs = [resultstore.result_path(out) for mass, xs, seed, out in points if out]
+    if args.generate_bank:
+        outputs = [bank_path(args.generate_bank, xs, mass) for mass, xs, seed, out in points] if scan else [args.generate_bank]
+    for path in outputs:
+        if not writable(path):
+            parser.error("cannot write %s"%path)
 
-            ds = r.RooDataSet("ds_%03d"%itrial, "ds_%03d"%itrial, ds, ds.get(), "", "wt")
-            ds.Print()
-            #xdummy = obs.getMin()
-            xdummy = args.ghost_start
-            while xdummy < obs.getMax():
-                obs.setVal(xdummy)
-                for xcat in ('bb', 'bj'):
-                    cat.setLabel(xcat)
-                    ds.add(r.RooArgSet(cat, obs), args.ghost_weight)
-                xdummy += args.ghost_interval
-        ds.Print()
-        datasets.append(ds)
-    if args.bias_adj is not None:
-        w.obj("bias_adj").setVal(args.bias_adj)
-
-    xsec.setVal(1)
-    xsec.setConstant(False)
-
-    other_keys = ['npbBSM', 'bias_bj', 'bias_bb']
-    if args.free_norm:
-        other_keys.extend([
-            'nbkg_fit_bj_bj',
-            'nbkg_fit_bb_bb',
-            ])
+    if args.generate_bank:
+        if args.dry_run:
+            for path in outputs:
+                print "Would write %d toys to %s"%(args.ntrial, path)
+            sys.exit(0)
+        if scan and not os.path.isdir(args.generate_bank):
+            os.makedirs(args.generate_bank)
+        init_worker(args)
+        for mass, xs, seed, out in points:
+            _fitter.write_bank(bank_path(args.generate_bank, xs, mass), mass, xs, seed, range(args.ntrial))
+        print "Total time:", (time.time() - START_TIME)
+        sys.exit(0)
+
+    if args.bias_table is not None:
+        # all points at once, to fail before any fit if the table has a hole
+        table = args.bias_table
+        pmass = np.array([p[0] for p in points], dtype=float)
+        pxs = np.array([p[1] for p in points])
+        adj = biasstats.interpolate_bias(table, pmass, pxs)
+        if not np.all(np.isfinite(adj)):
+            bad = ['x%s-m%d'%(p[1], p[0]) for p, ok in zip(points, np.isfinite(adj)) if not ok]
+            parser.error("the bias table %s has no value for %s"%(args.bias_adj_table, ', '.join(bad)))
+        outside = ((pmass < table['mass'][0]) | (pmass > table['mass'][-1]) |
+                (pxs < table['xsec'][0]) | (pxs > table['xsec'][-1]))
+        if np.any(outside):
+            print "Warning: %d points are outside the bias table and get the adjust of its edge"%np.sum(outside)
+
+    try:
+        trials = dict(((mass, xs), point_trials(args, xs, mass)) for mass, xs, seed, out in points)
+    except (IOError, ValueError) as e:
+        parser.error("cannot read the toy bank: %s"%e)
+
+    if args.dry_run:
+        for mass, xs, seed, out in points:
+            print "xsec=%g mX=%d seed=%d: %d trials -> %s"%(xs, mass, seed, len(trials[mass, xs]),
+                    resultstore.result_path(out) if out else '(not stored)')
+        sys.exit(0)
+    for mass, xs, seed, out in points:
+        if out and not os.path.isdir(os.path.dirname(os.path.abspath(out))):
+            if args.sharded:
+                resultstore.make_shard(args.out, xs, mass)
+            else:
+                os.makedirs(os.path.dirname(os.path.abspath(out)))
+    import_root()
+
+    renderer = PlotRenderer(args) if args.plots else None
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, init_worker, (args,))
     else:
-        other_keys.extend([
-            'bkg_constraint_bj',
-            'bkg_constraint_bb',
-            ])
-    if args.free_shape:
-        other_keys.extend([
-            'novosibirsk_peak_bj',
-            'novosibirsk_peak_bb',
-            'novosibirsk_tail_bj',
-            'novosibirsk_tail_bb',
-            'novosibirsk_width_bj',
-            'novosibirsk_width_bb',
-            ])
-    elif not args.freeze_shape:
-        other_keys.extend([
-            'bkg_constraint_shape_bj',
-            'bkg_constraint_shape_bb',
-            'bkg_constraint_tail_bj',
-            'bkg_constraint_tail_bb',
-            'bkg_constraint_width_bj',
-            'bkg_constraint_width_bb',
-            ])
-
-    poi_vals = []
-    other_vals = []
-    errs_lo = []
-    errs_hi = []
-    statuses = []
-    nll_invalid = []
-    status_skip = 0
-    if args.plots:
-        canvas = r.TCanvas("c1","c1", 800, 600)
-        canvas.cd()
-        pad1 = r.TPad("pad1","pad1",0,0.5,1,1)
-        pad1.Draw()
-        canvas.cd()
-        pad2 = r.TPad("pad2","pad2",0,0,1,0.5)
-        pad2.Draw()
-    for ds_idx,ds in enumerate(datasets):
-        if args.reinit:
-            print "Re-initializing NP and POI values."
-            for v in iterset(mc.GetNuisanceParameters()):
-                v.setVal(0)
-            xsec.setVal(0.5)
-        nll = pdf.createNLL(ds, r.RooFit.Offset(args.offset))
+        init_worker(args)
+    setup_time = time.time() - START_TIME
+
+    if args.workers > 1:
+        # one trial per task: trials are independent of each other, so
+        # this only affects the load balancing and not the results.
+        tasks = [(mass, xs, seed, [itrial], out) for mass, xs, seed, out in points for itrial in trials[mass, xs]]
+        results = itertools.chain.from_iterable(pool.imap(run_task, tasks))
+    else:
+        # a single stream that generates and fits one toy at a time
+        results = itertools.chain.from_iterable(_fitter.run_trials(mass, xs, seed, trials[mass, xs], out) for mass, xs, seed, out in points)
+
+    keys = fit_config(args).keys
+    for mass, xs, seed, out in points:
+        print "Grid point: xsec=%g mX=%d"%(xs, mass)
+        output = PointOutput(args, keys, mass, xs, seed, out, len(trials[mass, xs]), setup_time)
+        setup_time = 0
+        for result in itertools.islice(results, len(trials[mass, xs])):
+            if 'plot' in result:
+                renderer.submit(mass, xs, seed, result.pop('plot'))
+            output.add(result)
+        output.close()
+
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+    if renderer:
+        renderer.close()
 
-        fit_statuses = []
-        minimizer = r.RooMinuit(nll)
-        minimizer.migrad()
-        res = minimizer.save()
-        fit_statuses.append(res.status())
-        if args.hesse:
-            minimizer.hesse()
-            res = minimizer.save()
-            fit_statuses.append(res.status())
-        if not args.skip_minos:
-            minimizer.minos()
-            res = minimizer.save()
-            fit_statuses.append(res.status())
-
-        nll_invalid.append(res.numInvalidNLL())
-
-        if args.only_good and max(fit_statuses)>0:
-            status_skip += 1
-            continue
-
-        statuses.append( tuple(fit_statuses) )
-
-        if args.plots:
-            frame1 = w.obj("gg_mass").frame()
-            ds.plotOn(frame1, r.RooFit.Cut("channellist==channellist::bj"))
-            pdf.plotOn(frame1, r.RooFit.Slice(cat, "bj"), r.RooFit.ProjWData(r.RooArgSet(cat), ds), r.RooFit.LineColor(r.kRed))
-            pad1.cd()
-            frame1.SetTitle(";;")
-            frame1.GetXaxis().SetLabelSize(0.07)
-            frame1.Draw()
-            frame2 = w.obj("gg_mass").frame()
-            ds.plotOn(frame2, r.RooFit.Cut("channellist==channellist::bb"))
-            pdf.plotOn(frame2, r.RooFit.Slice(cat, "bb"), r.RooFit.ProjWData(r.RooArgSet(cat), ds), r.RooFit.LineColor(r.kRed))
-            pad2.cd()
-            frame2.SetTitle(";;")
-            frame2.GetXaxis().SetLabelSize(0.07)
-            frame2.Draw()
-            canvas.Update()
-            canvas.SaveAs(args.out+".%d.pdf"%ds_idx)
-
-        poi_vals.append(xsec.getVal())
-        other_vals.append(tuple([w.obj(k).getVal() for k in other_keys]))
-        errs_lo.append(tuple([w.obj(k).getAsymErrorLo() for k in other_keys]))
-        errs_hi.append(tuple([w.obj(k).getAsymErrorHi() for k in other_keys]))
-        if args.out:
-            np.save(args.out, poi_vals)
-            with open(args.out+'.pkl', 'wb') as fpkl:
-                cPickle.dump(dict(
-                        keys=other_keys,
-                        vals=other_vals,
-                        errs_lo=errs_lo,
-                        errs_hi=errs_hi,
-                        statuses=statuses,
-                        nll_invalid=nll_invalid,
-                        argv=sys.argv,
-                        jobid=os.environ.get('SLURM_JOBID', None),
-                        runtime=(time.time() - START_TIME)
-                    ),
-                    fpkl)
-
-    print "Skipped %d trials with bad status."%status_skip
     print "Total time:", (time.time() - START_TIME)
@@ -0,0 +1,275 @@
+''' Vectorized statistics over the trials of a scan, as loaded by
+resultstore.load_scan(). '''
+
+import os
+import json
+import numpy as np
+import resultstore
+
+def grid_points(cols, sel=None):
+    ''' The distinct (xs, mass) points and, for every trial, the index of
+        its point. Trials not in sel get index -1. '''
+    xs, mass = cols['xs'], cols['mass']
+    if sel is None:
+        sel = np.ones(len(xs), dtype=bool)
+    pts, inv = np.unique(np.rec.fromarrays([xs[sel], mass[sel]], names='xs,mass'), return_inverse=True)
+    group = -np.ones(len(xs), dtype=int)
+    group[sel] = inv
+    return pts, group
+
+def group_count(group, ngroup, valid=None):
+    if valid is not None:
+        group = group[valid]
+    return np.bincount(group[group>=0], minlength=ngroup)
+
+def group_mean(group, x, ngroup, valid=None):
+    ''' Mean and standard deviation of x in every group '''
+    ok = group >= 0
+    if valid is not None:
+        ok &= valid
+    g, x = group[ok], x[ok]
+    n = np.bincount(g, minlength=ngroup).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(g, weights=x, minlength=ngroup)/n
+        var = np.bincount(g, weights=x*x, minlength=ngroup)/n - mean**2
+    return mean, np.sqrt(np.maximum(var, 0))
+
+def group_median(group, x, ngroup, valid=None):
+    ''' Median of x in every group (NaN for empty groups) '''
+    ok = group >= 0
+    if valid is not None:
+        ok &= valid
+    g, x = group[ok], x[ok]
+    order = np.lexsort((x, g))
+    g, x = g[order], x[order]
+    n = np.bincount(g, minlength=ngroup)
+    start = np.cumsum(n) - n
+    med = np.full(ngroup, np.nan)
+    have = n > 0
+    lo = start[have] + (n[have]-1)//2
+    hi = start[have] + n[have]//2
+    med[have] = 0.5*(x[lo] + x[hi])
+    return med
+
+def expected_value(cols, key):
+    ''' The generated value of a parameter for each trial: the injected
+        cross section for the POI, zero for the NPs. '''
+    if key == 'npbBSM':
+        return cols['xs']
+    return np.zeros(len(cols['xs']))
+
+def pulls(cols, key):
+    ''' Per-trial values, errors and pulls of one parameter. The error is
+        the MINOS error on the side facing the expected value. '''
+    ik = list(cols['keys']).index(key)
+    vals = cols['vals'][:,ik]
+    expected = expected_value(cols, key)
+    errs = np.abs(np.where(vals < expected, cols['errs_hi'][:,ik], cols['errs_lo'][:,ik]))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pull = (vals - expected)/errs
+    return vals, errs, pull
+
+PULL_FIELDS = ['n', 'npull', 'pull_mean', 'pull_median', 'pull_std',
+        'val_mean', 'val_median', 'val_std', 'err_mean', 'err_std', 'median_bias']
+
+def pull_table(cols, keys=None, sel=None):
+    ''' Pull summary for every parameter in keys and every grid point.
+
+        Returns the grid points and a dict mapping each key to a record
+        array (one row per point) with the fields in PULL_FIELDS. Pulls
+        are only taken from trials with a non-zero error. '''
+    if keys is None:
+        keys = list(cols['keys'])
+    pts, group = grid_points(cols, sel)
+    npt = len(pts)
+    n = group_count(group, npt)
+
+    table = {}
+    for key in keys:
+        vals, errs, pull = pulls(cols, key)
+        has_val = np.isfinite(vals)
+        has_err = has_val & (errs > 0)
+        row = np.zeros(npt, dtype=[(f, 'i8' if f in ('n', 'npull') else 'f8') for f in PULL_FIELDS])
+        row['n'] = group_count(group, npt, has_val)
+        row['npull'] = group_count(group, npt, has_err)
+        row['pull_mean'], row['pull_std'] = group_mean(group, pull, npt, has_err)
+        row['pull_median'] = group_median(group, pull, npt, has_err)
+        row['val_mean'], row['val_std'] = group_mean(group, vals, npt, has_val)
+        row['val_median'] = group_median(group, vals, npt, has_val)
+        row['err_mean'], row['err_std'] = group_mean(group, errs, npt, has_val)
+        row['median_bias'] = group_median(group, vals - expected_value(cols, key), npt, has_val)
+        table[key] = row.view(np.recarray)
+    return pts, table
+
+def format_pull_table(pts, table, keys=None):
+    if keys is None:
+        keys = sorted(table.keys())
+    lines = []
+    for key in keys:
+        row = table[key]
+        lines.append(key)
+        lines.append("  %6s %5s %6s %9s %9s %9s %12s"%('xs', 'mX', 'n', 'pull avg', 'pull med', 'pull std', 'median bias'))
+        for ipt in xrange(len(pts)):
+            lines.append("  %6g %5d %6d %9.3f %9.3f %9.3f %12.4f"%(
+                pts['xs'][ipt], pts['mass'][ipt], row.npull[ipt],
+                row.pull_mean[ipt], row.pull_median[ipt], row.pull_std[ipt],
+                row.median_bias[ipt]))
+    return '\n'.join(lines)
+
+def bootstrap(x, n, seed=None, max_elements=10**7):
+    ''' Bootstrap errors (std over n resamples) of the median and the mean
+        of x. The resamples are drawn as index matrices of at most
+        max_elements entries at a time. '''
+    x = np.asarray(x)
+    if len(x) == 0:
+        return np.nan, np.nan
+    rng = np.random.RandomState(seed)
+    med = np.empty(n)
+    avg = np.empty(n)
+    chunk = max(1, max_elements // len(x))
+    for i0 in xrange(0, n, chunk):
+        m = min(chunk, n-i0)
+        sample = x[rng.randint(0, len(x), size=(m, len(x)))]
+        med[i0:i0+m] = np.median(sample, axis=1)
+        avg[i0:i0+m] = np.mean(sample, axis=1)
+    return np.std(med), np.std(avg)
+
+def median_error(x, z=1.96):
+    ''' Standard error of the median of x from the order statistics that
+        bracket it with confidence z (distribution free, no resampling).
+        NaN for fewer than three values. '''
+    x = np.sort(np.asarray(x))
+    n = len(x)
+    if n < 3:
+        return np.nan
+    half = 0.5*z*np.sqrt(n)
+    lo = max(int(np.floor(0.5*n - half)), 0)
+    hi = min(int(np.ceil(0.5*n + half)) - 1, n-1)
+    return (x[hi] - x[lo])/(2*z)
+
+def point_seed(seed, xs, mass):
+    ''' A seed for one grid point that does not depend on which other
+        points are being processed. '''
+    return [seed, int(round(xs*1e4)), int(mass)]
+
+def poi_summary(point, cols, nboot=None, seed=0):
+    ''' Number of fits, median and mean of the POI at one grid point, and
+        optionally their bootstrap errors. '''
+    poi = cols['poi']
+    summary = dict(n=len(poi), median=np.nan, mean=np.nan, med_bs=np.nan, avg_bs=np.nan)
+    if len(poi):
+        summary['median'] = np.median(poi)
+        summary['mean'] = np.mean(poi)
+    if nboot:
+        summary['med_bs'], summary['avg_bs'] = bootstrap(poi, nboot, point_seed(seed, *point))
+    return summary
+
+def point_pulls(point, cols, only_good=False):
+    ''' The pull_table() row of every parameter at one grid point, and the
+        number of trials dropped by only_good. '''
+    sel = None
+    nskip = 0
+    if only_good:
+        sel = resultstore.good_mask(cols)
+        nskip = np.sum(~sel)
+    pts, table = pull_table(cols, sel=sel)
+    rows = {}
+    if len(pts):
+        for k,row in table.iteritems():
+            rows[k] = row[0]
+    return dict(nskip=nskip, keys=list(cols['keys']), rows=rows)
+
+def join_pulls(results, points):
+    ''' Combine the point_pulls() of several points into the grid points,
+        table and keys of pull_table(). '''
+    keys = []
+    for p in points:
+        for k in results[p]['keys']:
+            if k not in keys:
+                keys.append(k)
+    pts = np.rec.fromarrays([[p[0] for p in points], [p[1] for p in points]], names='xs,mass')
+    dtype = [(f, 'i8' if f in ('n', 'npull') else 'f8') for f in PULL_FIELDS]
+    table = {}
+    for k in keys:
+        row = np.zeros(len(points), dtype=dtype)
+        for f in PULL_FIELDS[2:]:
+            row[f] = np.nan
+        for i,p in enumerate(points):
+            if k in results[p]['rows']:
+                row[i] = results[p]['rows'][k]
+        table[k] = row.view(np.recarray)
+    return pts, table, keys
+
+def median_precision(point, cols, nboot=None, seed=0):
+    ''' Number of fits, median bias of the POI and the standard error of
+        the median at one grid point. The error is taken from the order
+        statistics, or from nboot bootstrap resamples if nboot is given. '''
+    bias = cols['poi'] - point[0]
+    summary = dict(n=len(bias), median=np.nan, err=np.nan)
+    if len(bias):
+        summary['median'] = np.median(bias)
+    if nboot:
+        summary['err'] = bootstrap(bias, nboot, point_seed(seed, *point))[0]
+    else:
+        summary['err'] = median_error(bias)
+    return summary
+
+def bias_estimate(point, cols, nboot=None, seed=0):
+    ''' Median bias of the POI and its standard error at one grid point,
+        as median_precision(), plus the typical error of a single fit
+        (toy_err, the median MINOS error). For the fit of a bias-test.py
+        --asimov job, median is the bias of that fit and err is zero. '''
+    asimov = bool(np.any(cols.get('job_asimov', False)))
+    if asimov:
+        summary = dict(n=len(cols['poi']), median=np.median(cols['poi'] - point[0]), err=0.)
+    else:
+        summary = median_precision(point, cols, nboot, seed)
+    summary['asimov'] = asimov
+    summary['toy_err'] = np.nan
+    if 'npbBSM' in list(cols['keys']) and len(cols['poi']):
+        vals, errs, pull = pulls(cols, 'npbBSM')
+        if np.any(errs > 0):
+            summary['toy_err'] = np.median(errs[errs > 0])
+    return summary
+
+def write_bias_table(path, masses, xsecs, bias, err, **info):
+    ''' Write a table of the median bias (and its error) on the grid of
+        masses x xsecs; bias and err have one row per xsec. '''
+    table = dict(info, mass=list(masses), xsec=list(xsecs),
+            bias=np.asarray(bias).tolist(), err=np.asarray(err).tolist())
+    tmp = '%s.tmp'%path
+    with open(tmp, 'w') as f:
+        json.dump(table, f, indent=1)
+    os.rename(tmp, path)
+
+def read_bias_table(path):
+    with open(path) as f:
+        table = json.load(f)
+    for k in ('mass', 'xsec', 'bias', 'err'):
+        table[k] = np.array(table[k], dtype=float)
+    return table
+
+def _grid_weights(grid, x):
+    ''' Lower cell index and interpolation weight of x on a sorted grid,
+        constant beyond its ends '''
+    x = np.clip(x, grid[0], grid[-1])
+    if len(grid) == 1:
+        return np.zeros(np.shape(x), dtype=int), np.zeros(np.shape(x))
+    i = np.clip(np.searchsorted(grid, x, side='right') - 1, 0, len(grid)-2)
+    return i, (x - grid[i])/(grid[i+1] - grid[i])
+
+def interpolate_bias(table, mass, xs, field='bias'):
+    ''' Bilinear interpolation of a bias table at any (mass, xs); works on
+        scalars and arrays alike. The result is NaN only if a table point
+        it depends on is NaN '''
+    mass, xs = np.broadcast_arrays(np.asarray(mass, dtype=float), np.asarray(xs, dtype=float))
+    z = table[field]
+    im, wm = _grid_weights(table['mass'], mass)
+    ix, wx = _grid_weights(table['xsec'], xs)
+    im1 = np.minimum(im+1, len(table['mass'])-1)
+    ix1 = np.minimum(ix+1, len(table['xsec'])-1)
+    def term(w, zc):
+        # a corner with no weight must not spread a NaN at it
+        return np.where(w == 0, 0., w*zc)
+    return (term((1-wx)*(1-wm), z[ix,im]) + term((1-wx)*wm, z[ix,im1]) +
+            term(wx*(1-wm), z[ix1,im]) + term(wx*wm, z[ix1,im1]))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+''' Compare the median bias and the pulls of two scans point by point, e.g.
+a bias-test.py --asimov scan against full toys on a subset of the grid, or
+binned (--binned) against unbinned toys with the same seeds. '''
+
+import argparse
+import functools
+import numpy as np
+import biasstats
+import scancache
+
+def estimates(path, args):
+    return scancache.map_points(path,
+            'bias_estimate:bootstrap=%s:seed=%d'%(args.bootstrap, args.seed),
+            functools.partial(biasstats.bias_estimate, nboot=args.bootstrap, seed=args.seed),
+            use_cache=not args.no_cache)
+
+def point_pulls(path, args):
+    return scancache.map_points(path,
+            'point_pulls:only_good=%s'%args.only_good,
+            functools.partial(biasstats.point_pulls, only_good=args.only_good),
+            use_cache=not args.no_cache)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bootstrap", metavar="N", type=int, help="Errors of the median from N bootstrap samples rather than from the order statistics")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the bootstrap")
+    parser.add_argument("--var", default="npbBSM", help="The variable to compare the pulls of")
+    parser.add_argument("--only-good", action="store_true", help="Only compare the pulls of trials with 0/0 status")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use or update the caches in the scan directories")
+    parser.add_argument("reference", help="The reference scan (directory or merged scan file)")
+    parser.add_argument("other", help="The scan to compare to it")
+    args = parser.parse_args()
+
+    ref = estimates(args.reference, args)
+    other = estimates(args.other, args)
+    points = sorted(set(ref) & set(other))
+    print "%d points in common (%d only in the reference, %d only in the other scan)"%(
+            len(points), len(set(ref) - set(other)), len(set(other) - set(ref)))
+    if not points:
+        raise SystemExit
+
+    print "%6s %5s | %6s %9s %8s %8s | %6s %9s %8s %8s | %9s %7s"%('xs', 'mX',
+            'n', 'med bias', 'err', 'fit err', 'n', 'med bias', 'err', 'fit err', 'diff', 'signif')
+    signif = []
+    for point in points:
+        a, b = ref[point], other[point]
+        diff = b['median'] - a['median']
+        err = np.hypot(a['err'], b['err'])
+        s = diff/err if err > 0 else np.nan
+        signif.append(s)
+        print "%6g %5d | %6d %9.4f %8.4f %8.4f | %6d %9.4f %8.4f %8.4f | %9.4f %7.2f"%(point[0], point[1],
+                a['n'], a['median'], a['err'], a['toy_err'],
+                b['n'], b['median'], b['err'], b['toy_err'], diff, s)
+    signif = np.array(signif)
+    ok = np.isfinite(signif)
+    if np.any(ok):
+        print "chi2/ndf of the differences: %.1f/%d"%(np.sum(signif[ok]**2), np.sum(ok))
+        print "Points differing by more than 2 sigma: %d"%np.sum(np.abs(signif[ok]) > 2)
+
+    ref = point_pulls(args.reference, args)
+    other = point_pulls(args.other, args)
+    print
+    print "%s pulls"%args.var
+    print "%6s %5s | %6s %9s %9s | %6s %9s %9s | %9s %9s"%('xs', 'mX',
+            'n', 'pull avg', 'pull std', 'n', 'pull avg', 'pull std', 'avg diff', 'std ratio')
+    for point in points:
+        a = ref[point]['rows'].get(args.var)
+        b = other[point]['rows'].get(args.var)
+        if a is None or b is None:
+            continue
+        print "%6g %5d | %6d %9.3f %9.3f | %6d %9.3f %9.3f | %9.3f %9.3f"%(point[0], point[1],
+                a['npull'], a['pull_mean'], a['pull_std'],
+                b['npull'], b['pull_mean'], b['pull_std'],
+                b['pull_mean'] - a['pull_mean'], b['pull_std']/a['pull_std'])
@@ -0,0 +1,95 @@
+''' Fit model configurations for bias-test.py.
+
+A preset is a JSON file, either in presets/ (referred to by its name) or
+anywhere else (referred to by its path):
+
+    {
+        "description": "Fix the BIAS NP at zero",
+        "values": {"BIAS": 0},           initial parameter values
+        "constant": ["BIAS"],            parameters to fix
+        "floating": [],                  parameters to let float
+        "min": {"npbBSM": -1},           lower limits
+        "keys": [...],                   the parameters stored for every fit
+        "replace_keys": {"a": "b"}       store b in place of a (or drop a if null)
+    }
+
+All fields are optional. A configuration is a list of presets applied in
+order, so later presets win. The workspace parameters are looked up once,
+when the configuration is resolved against a workspace; nothing in here
+needs ROOT.
+'''
+
+import os
+import json
+
+PRESET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'presets')
+FIELDS = ('description', 'values', 'constant', 'floating', 'min', 'keys', 'replace_keys')
+
+def load_preset(name):
+    path = name
+    if not os.path.exists(path):
+        path = os.path.join(PRESET_DIR, name + '.json')
+    with open(path) as f:
+        preset = json.load(f)
+    unknown = set(preset) - set(FIELDS)
+    if unknown:
+        raise ValueError("Unknown fields in preset %s: %s"%(name, ', '.join(sorted(unknown))))
+    preset.setdefault('description', name)
+    return preset
+
+class FitConfig(object):
+    def __init__(self, presets):
+        self.presets = presets
+        keys = []
+        for p in presets:
+            if 'keys' in p:
+                keys = list(p['keys'])
+            for old, new in p.get('replace_keys', {}).iteritems():
+                if old not in keys:
+                    continue
+                if new is None:
+                    keys.remove(old)
+                else:
+                    keys[keys.index(old)] = new
+        self.keys = map(str, keys)
+        self.key_vars = None
+
+    def names(self):
+        ''' All parameters the configuration touches '''
+        names = set(self.keys)
+        for p in self.presets:
+            for field in ('values', 'constant', 'floating', 'min'):
+                names.update(p.get(field, ()))
+        return sorted(names)
+
+    def resolve(self, w):
+        ''' Look up every parameter in the workspace, once '''
+        self.vars = {}
+        for name in self.names():
+            v = w.var(str(name))
+            if not v:
+                raise KeyError("Parameter %s of the fit configuration is not in the workspace"%name)
+            self.vars[name] = v
+        self.key_vars = [self.vars[k] for k in self.keys]
+
+    def apply(self):
+        ''' Set the initial values, ranges and constness of all presets '''
+        for p in self.presets:
+            print "Preset: %s"%p['description']
+            for name, val in p.get('values', {}).iteritems():
+                self.vars[name].setVal(val)
+            for name in p.get('constant', ()):
+                self.vars[name].setConstant(True)
+            for name in p.get('floating', ()):
+                self.vars[name].setConstant(False)
+            for name, val in p.get('min', {}).iteritems():
+                self.vars[name].setMin(val)
+
+    def read(self):
+        ''' Values, lower and upper errors of the stored parameters '''
+        vals, errs_lo, errs_hi = [], [], []
+        for v in self.key_vars:
+            vals.append(v.getVal())
+            errs_lo.append(v.getAsymErrorLo())
+            errs_hi.append(v.getAsymErrorHi())
+        return tuple(vals), tuple(errs_lo), tuple(errs_hi)
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+
+import os
+import argparse
+import resultstore
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact the fit results of a scan directory into one file")
+    parser.add_argument("--out", help="Output file (default: <input_dir>/%s)"%resultstore.MERGED_NAME)
+    parser.add_argument("--rebuild-manifests", action="store_true", help="First recreate the shard manifests of a sharded scan from the result files in its shards (no job may be running)")
+    parser.add_argument("input_dir", help="The directory containing fit results")
+    args = parser.parse_args()
+
+    if args.rebuild_manifests:
+        resultstore.rebuild_manifests(args.input_dir)
+    else:
+        resultstore.compact_manifests(args.input_dir)
+    out = args.out or os.path.join(args.input_dir, resultstore.MERGED_NAME)
+    cols = resultstore.merge_scan(args.input_dir)
+    resultstore.save_scan(out, cols)
+    print "Merged %d trials from %d jobs (%d grid points) into %s"%(
+            len(cols['poi']), len(cols['job_index']),
+            len(set(zip(cols['job_xs'], cols['job_mass']))), out)
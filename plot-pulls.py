@@ -1,117 +1,158 @@
 #!/usr/bin/env python
 
 import sys, os
+import json
 import argparse
-from glob import glob
-import cPickle
-import matplotlib.pyplot as plt
+import functools
+import multiprocessing
 import numpy as np
-A = np.array
+import resultstore
+import biasstats
+import scancache
+# matplotlib is only imported once something is drawn
 
-def parse_filename(fname):
-    f0 = os.path.basename(fname)
-    if f0.endswith('.npy.pkl'):
-        f0 = f0[:-len('.npy.pkl')]
-    else:
-        f0 = f0[:-len('.pkl')]
-    items = f0.split('-')[1:]
-    info = {}
-    for itm in items:
-        if itm.startswith('x'):
-            info['xs'] = float(itm[1:])
-        elif itm.startswith('m'):
-            info['mass'] = int(itm[1:])
-    return info
+def point_histograms(variable, xs, mass, vals, errs, pulls):
+    ''' Draw the pull, value and error histograms of one grid point into
+        figures 1-3 '''
+    plt.figure(1)
+    plt.clf()
+    plt.hist(pulls, histtype='step', label='avg=%0.2f med=%0.2f std=%0.2f'%(np.mean(pulls), np.median(pulls), np.std(pulls)))
+    plt.axvline(0, color='black')
+    plt.title("%s (xs=%g, m=%g)" % (variable, xs, mass))
+    plt.legend()
+    plt.figure(2)
+    plt.clf()
+    plt.hist(vals, histtype='step', label='avg=%0.2f med=%0.2f std=%0.2f'%(np.mean(vals), np.median(vals), np.std(vals)))
+    plt.hist(vals[errs>0], histtype='step', label='(nonzero errro) avg=%0.2f std=%0.2f'%(np.mean(vals[errs>0]), np.std(vals[errs>0])))
+    plt.title("%s vals (xs=%g, m=%g)" % (variable, xs, mass))
+    plt.legend()
+    plt.figure(3)
+    plt.clf()
+    plt.hist(errs, histtype='step', label='avg=%0.2f std=%0.2f'%(np.mean(errs), np.std(errs)))
+    plt.title("%s errs (xs=%g, m=%g)" % (variable, xs, mass))
+    plt.legend()
+
+# file names of figures 1-3 in a report
+POINT_FIGURES = ['pulls', 'vals', 'errs']
+
+def save_point_histograms(task):
+    report, variable, xs, mass, vals, errs, pulls = task
+    point_histograms(variable, xs, mass, vals, errs, pulls)
+    for num, name in enumerate(POINT_FIGURES, 1):
+        plt.figure(num).savefig(os.path.join(report, '%s-%s-x%s-m%d.pdf'%(name, variable, xs, mass)))
+
+def pull_rows(pts, table, keys):
+    ''' The pull table as one dict per (point, parameter), NaN as None '''
+    rows = []
+    for i, pt in enumerate(pts):
+        for k in keys:
+            row = dict(xs=float(pt['xs']), mass=int(pt['mass']), var=k)
+            for f in biasstats.PULL_FIELDS:
+                v = table[k][f][i].item()
+                row[f] = v if not isinstance(v, float) or np.isfinite(v) else None
+            rows.append(row)
+    return rows
 
 if __name__ == "__main__":
-    print "starting!"
     parser = argparse.ArgumentParser()
     parser.add_argument("--show-all", action="store_true", help="Show all individual pull plots")
-    parser.add_argument("--var", default="npbBSM", help="The variable to plot pulls for")
+    parser.add_argument("--var", default="npbBSM", help="The variable to plot pulls for (the summary table covers all of them)")
     parser.add_argument("--only-good", action="store_true", help="Only keep trials with 0/0 status")
-    parser.add_argument("directory", help='The directory containing pkl files with fit results')
+    parser.add_argument("--table", metavar="FILE", help="Also write the pull summary table of all parameters to FILE")
+    parser.add_argument("--report", metavar="DIR", help="Do not show anything; write every figure, including the histograms of every point, and the table to DIR")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes to draw the report's histograms in")
+    parser.add_argument("--summary", choices=['text', 'json'], help="Only print the pull summary table and draw nothing")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use or update the cache in the scan directory")
+    parser.add_argument("input", help='The directory containing fit results, or a merged scan file')
     args = parser.parse_args()
 
-    plt.ion()
+    if args.report:
+        if not os.path.isdir(args.report):
+            os.makedirs(args.report)
+        if not args.table:
+            args.table = os.path.join(args.report, 'pulls.txt')
 
-    trials = {}
-    for fname in glob(os.path.join(args.directory, '*.pkl')):
-        info = parse_filename(fname)
-        xs = info['xs']
-        if xs==0.75: continue
-        mass = info['mass']
+    # keep stdout clean for the JSON summary
+    log = sys.stderr if args.summary == 'json' else sys.stdout
+    results = scancache.map_points(args.input,
+            'point_pulls:only_good=%s'%args.only_good,
+            functools.partial(biasstats.point_pulls, only_good=args.only_good),
+            use_cache=not args.no_cache, verbose=args.summary != 'json')
+    points = sorted(p for p in results if p[0] != 0.75 and results[p]['rows'])
+    for xs, mass in points:
+        if results[xs,mass]['nskip'] > 0:
+            print >>log, "Skipped %d trials due to error status. (xs=%g, m=%g)" % (results[xs,mass]['nskip'], xs, mass)
+    pts, table, keys = biasstats.join_pulls(results, points)
 
-        if not xs in trials:
-            trials[xs] = {}
-        if not mass in trials[xs]:
-            trials[xs][mass] = []
+    summary = biasstats.format_pull_table(pts, table, keys)
+    if args.summary == 'json':
+        json.dump(pull_rows(pts, table, keys), sys.stdout, indent=1, sort_keys=True)
+        print
+    else:
+        print summary
+    if args.table:
+        with open(args.table, 'w') as f:
+            f.write(summary+'\n')
+    if args.summary:
+        sys.exit(0)
 
-        pkl = cPickle.load(open(fname))
+    import matplotlib
+    if args.report:
+        # no display needed; has to be chosen before pyplot is loaded
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    if not args.report:
+        plt.ion()
 
-        status_skip = 0
-        for itrial in xrange(len(pkl['vals'])):
-            trial_results = {}
-            trial_results["statuses"] = pkl['statuses'][itrial]
-            if args.only_good and max(trial_results["statuses"])>0:
-                status_skip += 1
-                continue
-            for i,k in enumerate(pkl['keys']):
-                trial_results[k] = pkl['vals'][itrial][i]
-                trial_results[k+"_lo"] = pkl['errs_lo'][itrial][i]
-                trial_results[k+"_hi"] = pkl['errs_hi'][itrial][i]
-            trials[xs][mass].append(trial_results)
+    variable = args.var
+    if args.show_all or args.report:
+        scan = resultstore.load_scan(args.input)
+        sel = scan['xs'] != 0.75
+        if args.only_good:
+            sel &= resultstore.good_mask(scan)
+        vals, errs, pulls = biasstats.pulls(scan, variable)
 
-        if status_skip>0:
-            print "Skipped %d trials due to error status. (xs=%g, m=%g)" % (status_skip, xs, mass)
+    def point_data(xs, mass):
+        pt = sel & (scan['xs'] == xs) & (scan['mass'] == mass)
+        return vals[pt], errs[pt], pulls[pt & (errs>0)]
 
-    variable = args.var
-    for ixs,xs in enumerate(sorted(trials.keys())):
-        masses = A(sorted(trials[xs].keys()))
-        pulls = []
-        median_bias = []
-        for mass in masses:
-            median_bias.append(np.median([x['npbBSM']-xs for x in trials[xs][mass]]))
-            plt.figure(1)
-            plt.clf()
-            poi_vals = A([x[variable] for x in trials[xs][mass]])
-            if variable=='npbBSM':
-                expected=xs
-            else:
-                expected=0
-            poi_errs = np.abs(A([x['%s_hi'%variable] if x[variable]<expected else x['%s_lo'%variable] for x in trials[xs][mass]]))
-            poi_pulls = (poi_vals-expected)/poi_errs
-            poi_pulls = poi_pulls[poi_errs>0]
-            plt.hist(poi_pulls, histtype='step', label='avg=%0.2f med=%0.2f std=%0.2f'%(np.mean(poi_pulls), np.median(poi_pulls), np.std(poi_pulls)))
-            pulls.append( (np.mean(poi_pulls), np.std(poi_pulls)) )
-            plt.axvline(0, color='black')
-            plt.title("%s (xs=%g, m=%g)" % (variable, xs, mass))
-            plt.legend()
-            plt.figure(2)
-            plt.clf()
-            plt.hist(poi_vals, histtype='step', label='avg=%0.2f med=%0.2f std=%0.2f'%(np.mean(poi_vals), np.median(poi_pulls), np.std(poi_vals)))
-            plt.hist(poi_vals[poi_errs>0], histtype='step', label='(nonzero errro) avg=%0.2f std=%0.2f'%(np.mean(poi_vals[poi_errs>0]), np.std(poi_vals[poi_errs>0])))
-            plt.title("%s vals (xs=%g, m=%g)" % (variable, xs, mass))
-            plt.legend()
-            plt.figure(3)
-            plt.clf()
-            plt.hist(poi_errs, histtype='step', label='avg=%0.2f std=%0.2f'%(np.mean(poi_errs), np.std(poi_errs)))
-            plt.title("%s errs (xs=%g, m=%g)" % (variable, xs, mass))
-            plt.legend()
-            if args.show_all:
+    if args.report:
+        tasks = [(args.report, variable, xs, mass) + point_data(xs, mass) for xs, mass in points]
+        if args.workers > 1:
+            pool = multiprocessing.Pool(args.workers)
+            pool.map(save_point_histograms, tasks)
+            pool.close()
+            pool.join()
+        else:
+            map(save_point_histograms, tasks)
+        print "Wrote the histograms of %d points to %s"%(len(tasks), args.report)
+
+    for ixs,xs in enumerate(np.unique(pts['xs'])):
+        in_xs = pts['xs'] == xs
+        masses = pts['mass'][in_xs]
+        row = table[variable][in_xs]
+        if args.show_all and not args.report:
+            for mass in masses:
+                point_histograms(variable, xs, mass, *point_data(xs, mass))
                 raw_input("press enter")
-        pulls = A(pulls)
 
         plt.figure(4)
         if ixs==0:
             plt.fill_between(masses, 1.*np.ones_like(masses), -1.*np.ones_like(masses), facecolor='black', alpha=0.2)
             plt.plot(masses, np.zeros_like(masses), color='black')
-        plt.errorbar(masses+2*ixs, pulls[:,0], yerr=pulls[:,1], fmt='o', label='xs=%g'%xs)
+        plt.errorbar(masses+2*ixs, row.pull_mean, yerr=row.pull_std, fmt='o', label='xs=%g'%xs)
         plt.title("%s pulls"%variable)
         plt.legend(loc='lower center')
         
         plt.figure(5)
-        plt.plot(masses, median_bias, label='xs=%g'%xs)
+        plt.plot(masses, table['npbBSM'].median_bias[in_xs], label='xs=%g'%xs)
         plt.title('median bias')
         plt.legend()
+        if not args.report:
+            raw_input('press enter')
+    if args.report:
+        plt.figure(4).savefig(os.path.join(args.report, 'pull_means-%s.pdf'%variable))
+        plt.figure(5).savefig(os.path.join(args.report, 'median_bias.pdf'))
+        print "Wrote the report to", args.report
+    else:
         raw_input('press enter')
-    raw_input('press enter')
@@ -1,56 +1,96 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import json
 import argparse
-from glob import glob
+import functools
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
-
-def parse_filename(fname):
-    f0 = os.path.basename(fname)
-    f0 = f0[:-len('.npy')]
-    items = f0.split('-')[1:]
-    info = {}
-    for itm in items:
-        if itm.startswith('x'):
-            info['xs'] = float(itm[1:])
-        elif itm.startswith('m'):
-            info['mass'] = int(itm[1:])
-    return info
+import biasstats
+import scancache
+# matplotlib and scipy are only imported once a figure or fit is needed
+
+def write_summary(data, fmt, out):
+    ''' Per-point fit count, median, mean and bias of the POI as a text
+        table or as JSON '''
+    rows = []
+    for xs in sorted(data):
+        for mass in sorted(data[xs]):
+            summary = data[xs][mass]
+            rows.append(dict(xs=xs, mass=mass, n=summary['n'],
+                    median=summary['median'], mean=summary['mean'], bias=summary['median'] - xs,
+                    med_err=summary['med_bs'], avg_err=summary['avg_bs']))
+    if fmt == 'json':
+        for row in rows:
+            for k, v in row.items():
+                if isinstance(v, float) and not np.isfinite(v):
+                    row[k] = None
+        json.dump(rows, out, indent=1, sort_keys=True)
+        out.write('\n')
+        return
+    out.write("%6s %5s %6s %9s %9s %9s %9s\n"%('xs', 'mX', 'n', 'median', 'mean', 'med bias', 'err'))
+    for row in rows:
+        out.write("%6g %5d %6d %9.4f %9.4f %9.4f %9.4f\n"%(row['xs'], row['mass'], row['n'],
+            row['median'], row['mean'], row['bias'], row['med_err']))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--do-fit", action="store_true", help="Do a fit of bias vs. injected")
     parser.add_argument("--bootstrap", metavar="N", type=int, help="Compute errorbars using N trials.")
-    parser.add_argument("input_dir", help="The directory containing fit results")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the bootstrap")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes to run the bootstrap in")
+    parser.add_argument("--report", metavar="DIR", help="Do not show anything; write every figure to DIR")
+    parser.add_argument("--export-bias-table", metavar="FILE", help="Write the median bias and its bootstrap error on the (mX, xsec) grid, for bias-test.py --bias-adj-table")
+    parser.add_argument("--summary", choices=['text', 'json'], help="Only print the per-point summary (with --bootstrap, with its errors) and draw nothing")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use or update the cache in the scan directory")
+    parser.add_argument("input", help="The directory containing fit results, or a merged scan file")
     args = parser.parse_args()
+    if args.export_bias_table and not args.bootstrap:
+        parser.error("--export-bias-table needs the bootstrap errors (--bootstrap)")
 
-    plt.ion()
-
+    summaries = scancache.map_points(args.input,
+            'poi_summary:bootstrap=%s:seed=%d'%(args.bootstrap, args.seed),
+            functools.partial(biasstats.poi_summary, nboot=args.bootstrap, seed=args.seed),
+            workers=args.workers, use_cache=not args.no_cache, verbose=args.summary != 'json')
     data = {}
-    for f in glob(os.path.join(args.input_dir, 'fits-*.npy')):
-        info = parse_filename(f)
-        xs = info['xs']
-        mass = info['mass']
-
-        if xs not in data:
-            data[xs] = {}
-
-        if mass not in data[xs]:
-            try:
-                data[xs][mass] = np.load(f)
-            except IOError:
-                print "Warning, IOError when opening", f
-            except ValueError:
-                print "Warning, ValueError when opening", f
-        else:
-            try:
-                data[xs][mass] = np.hstack([data[xs][mass], np.load(f)])
-            except IOError:
-                print "Warning, IOError when opening", f
-            except ValueError:
-                print "Warning, ValueError when opening", f
+    for (xs, mass), summary in summaries.iteritems():
+        data.setdefault(xs, {})[mass] = summary
+
+    # keep stdout clean for the JSON summary
+    log = sys.stderr if args.summary == 'json' else sys.stdout
+    if args.export_bias_table:
+        xsecs = sorted(data)
+        masses = sorted(set(m for xs in data for m in data[xs]))
+        bias = np.full((len(xsecs), len(masses)), np.nan)
+        err = np.full((len(xsecs), len(masses)), np.nan)
+        for i, xs in enumerate(xsecs):
+            for j, mass in enumerate(masses):
+                if mass in data[xs]:
+                    bias[i,j] = data[xs][mass]['median'] - xs
+                    err[i,j] = data[xs][mass]['med_bs']
+        biasstats.write_bias_table(args.export_bias_table, masses, xsecs, bias, err,
+                source=os.path.abspath(args.input), bootstrap=args.bootstrap, seed=args.seed)
+        print >>log, "Wrote the bias table (%d xsec x %d mX) to %s"%(len(xsecs), len(masses), args.export_bias_table)
+        if np.any(np.isnan(bias)):
+            print >>log, "Warning: %d points of the grid are missing in the scan"%np.sum(np.isnan(bias))
+
+    if args.summary:
+        write_summary(data, args.summary, sys.stdout)
+        sys.exit(0)
+
+    import matplotlib
+    if args.report:
+        # no display needed; has to be chosen before pyplot is loaded
+        matplotlib.use('Agg')
+        if not os.path.isdir(args.report):
+            os.makedirs(args.report)
+    import matplotlib.pyplot as plt
+    if not args.report:
+        plt.ion()
+
+    outdir = args.input if os.path.isdir(args.input) else os.path.dirname(args.input)
+    if args.report:
+        outdir = args.report
 
     adjustments = []
     adjustments_avg = []
@@ -63,14 +103,15 @@ if __name__ == "__main__":
         masses = sorted(data[xs].keys())
         nfits = []
         for mass in masses:
-            print "  mass %d  "%mass, len(data[xs][mass])
-            nfits.append(len(data[xs][mass]))
-            avg.append(np.mean(data[xs][mass]))
-            med.append(np.median(data[xs][mass]))
+            summary = data[xs][mass]
+            print "  mass %d  "%mass, summary['n']
+            nfits.append(summary['n'])
+            avg.append(summary['mean'])
+            med.append(summary['median'])
             # bootstrap median errors
             if args.bootstrap:
-                med_bs.append(np.std([np.median(np.random.choice(data[xs][mass], size=len(data[xs][mass]))) for _ in xrange(args.bootstrap)]))
-                avg_bs.append(np.std([np.mean(np.random.choice(data[xs][mass], size=len(data[xs][mass]))) for _ in xrange(args.bootstrap)]))
+                med_bs.append(summary['med_bs'])
+                avg_bs.append(summary['avg_bs'])
         med = np.array(med)
         med_bs = np.array(med_bs)
         avg_bs = np.array(avg_bs)
@@ -108,29 +149,29 @@ if __name__ == "__main__":
     plt.ylabel('median best-fit signal [pb]')
     plt.xlabel('mX [GeV]')
     plt.legend()
-    plt.savefig(os.path.join(args.input_dir,'median_signal.pdf'))
+    plt.savefig(os.path.join(outdir,'median_signal.pdf'))
     plt.figure(2)
     plt.ylabel('median bias (absolute) [pb]')
     plt.xlabel('mX [GeV]')
     plt.legend()
-    plt.savefig(os.path.join(args.input_dir,'median_bias.pdf'))
+    plt.savefig(os.path.join(outdir,'median_bias.pdf'))
     plt.figure(5)
     plt.ylabel('average bias (absolute) [pb]')
     plt.xlabel('mX [GeV]')
     plt.legend()
-    plt.savefig(os.path.join(args.input_dir,'average_bias.pdf'))
+    plt.savefig(os.path.join(outdir,'average_bias.pdf'))
 
     plt.figure(6)
     plt.ylabel('number of successful P.E.')
     plt.xlabel('mX [GeV]')
     plt.legend()
-    plt.savefig(os.path.join(args.input_dir,'nfit.pdf'))
+    plt.savefig(os.path.join(outdir,'nfit.pdf'))
 
     plt.figure(3)
     plt.ylabel('median bias (fractional)')
     plt.xlabel('mX [GeV]')
     plt.legend()
-    plt.savefig(os.path.join(args.input_dir,'median_bias_frac.pdf'))
+    plt.savefig(os.path.join(outdir,'median_bias_frac.pdf'))
     plt.figure(2)
     plt.figure(1)
 
@@ -144,6 +185,7 @@ if __name__ == "__main__":
     plt.legend()
 
     if args.do_fit:
+        from scipy.optimize import curve_fit
         def fn(x, a, b, c):
             return a*((1-x)**b) + c
         popt, pcov = curve_fit(fn, adjustments[:,0], adjustments[:,1], sigma=adjustments[:,2])
@@ -151,4 +193,8 @@ if __name__ == "__main__":
         print pcov
         plt.plot(adjustments[:,0], fn(adjustments[:,0], *popt))
 
-    raw_input('press enter')
+    if args.report:
+        plt.savefig(os.path.join(outdir, 'bias_adjust.pdf'))
+        print "Wrote the report to", outdir
+    else:
+        raw_input('press enter')
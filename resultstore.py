@@ -0,0 +1,529 @@
+''' Append-only storage of bias-test.py fit results.
+
+A result file holds a fixed-size preamble, a JSON header (fit keys, argv,
+record layout, ...) and then one fixed-width binary record per trial:
+
+    magic[8] complete[1] pad[3] header_len[4] runtime[8] ntried[4] pad[4]
+    header[header_len]
+    record, record, ...
+
+The file is created atomically (written under a temporary name and then
+renamed), records are appended with a single write() each, and the
+complete/runtime/ntried fields of the preamble are updated in place when
+the job finishes. Readers ignore a partially written final record, so a
+job killed at any point leaves a readable file behind. Every job writes
+its own file, so no locking is needed on shared filesystems.
+
+A scan directory is either flat (all result files in it) or sharded by
+grid point, x<xs>/m<mass>/fits-x<xs>-m<mass>-<job>.res. Every job of a
+sharded scan keeps an entry (seed, ntrial, complete, number of fits and
+of good fits, ...) in <shard>/manifest.d/<result file>.json, written under
+a temporary name and renamed into place when the job starts and again
+when it closes its result file; no two jobs ever write the same file.
+compact_manifests() folds the entries into one MANIFEST.json per shard;
+scan.py does so before every round and merge-scan.py before merging.
+Readers find the results of a sharded scan from the manifests and entry
+files alone, so they never list the result files: reading a scan opens
+one manifest per shard plus the entry files written since the last
+compaction. The manifests can be rebuilt from the shards with
+rebuild_manifests().
+'''
+
+import os
+import json
+import socket
+import struct
+import cPickle
+from glob import glob
+import numpy as np
+
+MAGIC = 'BBYYRES1'
+PREAMBLE = struct.Struct('<8sB3xIdI4x')
+EXTENSION = '.res'
+
+# migrad, hesse, minos; -1 for a step that was not run
+NSTATUS = 3
+
+def result_dtype(nkeys, extra=()):
+    return np.dtype([
+        ('trial', '<i4'),
+        ('poi', '<f8'),
+        ('vals', '<f8', (nkeys,)),
+        ('errs_lo', '<f8', (nkeys,)),
+        ('errs_hi', '<f8', (nkeys,)),
+        ('statuses', '<i1', (NSTATUS,)),
+        ('nll_invalid', '<i4'),
+        ('ncall_migrad', '<i4'),
+        ('ncall_minos', '<i4'),
+        ('fit_time', '<f8'),
+        ('peak_rss', '<f4'),
+        ('runtime', '<f8'),
+        ] + list(extra))
+
+def result_path(out):
+    ''' The result file for an --out name like fits-x1.0-m300-0.npy '''
+    if out.endswith('.npy'):
+        out = out[:-len('.npy')]
+    return out + EXTENSION
+
+def tmp_name(path):
+    ''' A temporary name for path that is unique across the hosts sharing
+        the filesystem '''
+    return '%s.tmp.%s.%d'%(path, socket.gethostname(), os.getpid())
+
+def _descr_to_dtype(descr):
+    fields = []
+    for d in descr:
+        if len(d) > 2:
+            fields.append((str(d[0]), str(d[1]), tuple(d[2])))
+        else:
+            fields.append((str(d[0]), str(d[1])))
+    return np.dtype(fields)
+
+class ResultWriter(object):
+    ''' With manifest=True the file is entered into the manifest of its
+        directory, as incomplete when it is created and again when it is
+        closed. '''
+    def __init__(self, path, dtype, manifest=False, **header):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.ntried = 0
+        self.nrec = 0
+        self.ngood = 0
+        self.manifest = manifest
+        self.info = dict((k, header.get(k)) for k in ('seed', 'ntrial', 'xsec', 'mX', 'jobid'))
+
+        header['dtype'] = self.dtype.descr
+        hdr = json.dumps(header)
+        self.hdr_len = len(hdr)
+        tmp = tmp_name(path)
+        with open(tmp, 'wb') as f:
+            f.write(PREAMBLE.pack(MAGIC, 0, len(hdr), 0, 0))
+            f.write(hdr)
+        os.rename(tmp, path)
+
+        self.fd = os.open(path, os.O_WRONLY|os.O_APPEND)
+        if manifest:
+            self.write_entry(complete=False, runtime=0.)
+
+    def write_entry(self, complete, runtime):
+        entry = dict(self.info, complete=complete, nfit=self.nrec, ngood=self.ngood,
+                ntried=self.ntried, runtime=runtime, size=os.path.getsize(self.path))
+        write_entry(os.path.dirname(self.path), os.path.basename(self.path), entry)
+
+    def append(self, record):
+        rec = np.zeros(1, dtype=self.dtype)
+        for k,v in record.iteritems():
+            rec[k] = v
+        os.write(self.fd, rec.tobytes())
+        self.ntried += 1
+        self.nrec += 1
+        if np.max(rec['statuses']) <= 0:
+            self.ngood += 1
+
+    def skip(self):
+        ''' Count a trial that was run but is not stored '''
+        self.ntried += 1
+
+    def close(self, runtime, complete=True):
+        os.close(self.fd)
+        # O_APPEND ignores the file position, so reopen to update the preamble
+        fd = os.open(self.path, os.O_WRONLY)
+        try:
+            os.write(fd, PREAMBLE.pack(MAGIC, int(complete), self.hdr_len, runtime, self.ntried))
+        finally:
+            os.close(fd)
+        if self.manifest:
+            self.write_entry(complete, runtime)
+
+def read_results(path):
+    ''' Read a result file into a dict with the same entries as the old
+        pickle output (keys, vals, errs_lo, errs_hi, statuses, nll_invalid,
+        argv, jobid, runtime) plus the poi values, the raw records and the
+        job state. Old-style .pkl files are read as well. '''
+    if path.endswith('.pkl'):
+        return _read_pickle(path)
+
+    with open(path, 'rb') as f:
+        buf = f.read()
+    if len(buf) < PREAMBLE.size:
+        raise ValueError("Truncated result file: %s"%path)
+    magic, complete, hdr_len, runtime, ntried = PREAMBLE.unpack(buf[:PREAMBLE.size])
+    if magic != MAGIC:
+        raise ValueError("Not a result file: %s"%path)
+    offset = PREAMBLE.size + hdr_len
+    header = json.loads(buf[PREAMBLE.size:offset])
+    dtype = _descr_to_dtype(header.pop('dtype'))
+
+    # a job killed mid-write can leave a partial last record behind
+    nrec = (len(buf) - offset) // dtype.itemsize
+    records = np.frombuffer(buf, dtype=dtype, count=nrec, offset=offset)
+
+    d = dict(header)
+    d['keys'] = map(str, header['keys'])
+    d['records'] = records
+    d['complete'] = bool(complete)
+    d['ntried'] = ntried if complete else None
+    for k in ('poi', 'vals', 'errs_lo', 'errs_hi', 'statuses', 'nll_invalid'):
+        d[k] = records[k]
+    if complete:
+        d['runtime'] = runtime
+    else:
+        d['runtime'] = records['runtime'][-1] if nrec else 0.
+    return d
+
+def _read_pickle(path):
+    with open(path, 'rb') as f:
+        d = cPickle.load(f)
+    nkeys = len(d['keys'])
+    vals = np.array(d['vals'], dtype=float).reshape(-1, nkeys)
+    statuses = -np.ones((len(d['statuses']), NSTATUS), dtype=int)
+    for i,st in enumerate(d['statuses']):
+        statuses[i,:len(st)] = st
+    d['vals'] = vals
+    d['errs_lo'] = np.array(d['errs_lo'], dtype=float).reshape(-1, nkeys)
+    d['errs_hi'] = np.array(d['errs_hi'], dtype=float).reshape(-1, nkeys)
+    d['statuses'] = statuses
+    d['poi'] = vals[:,d['keys'].index('npbBSM')]
+    d['complete'] = True
+    d['ntried'] = len(d['nll_invalid'])
+    return d
+
+MANIFEST_NAME = 'MANIFEST.json'
+
+def shard_dir(root, xs, mass):
+    return os.path.join(root, 'x%s'%xs, 'm%d'%mass)
+
+def make_shard(root, xs, mass):
+    ''' Create a shard directory; many jobs may try at the same time '''
+    shard = shard_dir(root, xs, mass)
+    try:
+        os.makedirs(shard)
+    except OSError:
+        if not os.path.isdir(shard):
+            raise
+    return shard
+
+def shard_out(root, xs, mass, job):
+    ''' The --out name of a job in a sharded scan directory '''
+    return os.path.join(shard_dir(root, xs, mass), 'fits-x%s-m%d-%d'%(xs, mass, job))
+
+ENTRY_DIR = 'manifest.d'
+
+def _read_json(path, verbose=True):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError:
+        return None
+    except ValueError as e:
+        if verbose:
+            print "Warning, ignoring corrupt manifest %s (%s)"%(path, e)
+        return None
+
+def write_entry(shard, name, entry):
+    ''' Write the manifest entry of the result file name in a shard '''
+    entry_dir = os.path.join(shard, ENTRY_DIR)
+    try:
+        os.mkdir(entry_dir)
+    except OSError:
+        if not os.path.isdir(entry_dir):
+            raise
+    path = os.path.join(entry_dir, name + '.json')
+    tmp = tmp_name(path)
+    with open(tmp, 'w') as f:
+        json.dump(dict(entry, name=name), f, sort_keys=True)
+    os.rename(tmp, path)
+
+def read_manifest(shard, verbose=True):
+    ''' File name -> entry of every job in a shard: the compacted
+        MANIFEST.json, overridden by the entry files '''
+    entries = _read_json(os.path.join(shard, MANIFEST_NAME), verbose) or {}
+    entry_dir = os.path.join(shard, ENTRY_DIR)
+    try:
+        names = os.listdir(entry_dir)
+    except OSError:
+        names = []
+    # entry files that a compaction has taken over but not yet removed
+    # are older than any entry file of the same job
+    names.sort(key=lambda n: not n.endswith('.compacting'))
+    for name in names:
+        if not (name.endswith('.json') or name.endswith('.compacting')):
+            continue
+        entry = _read_json(os.path.join(entry_dir, name), verbose)
+        if entry is not None:
+            entries[entry.pop('name')] = entry
+    return entries
+
+def write_manifest(shard, entries):
+    path = os.path.join(shard, MANIFEST_NAME)
+    tmp = tmp_name(path)
+    with open(tmp, 'w') as f:
+        json.dump(entries, f, sort_keys=True)
+    os.rename(tmp, path)
+
+def compact_manifest(shard):
+    ''' Fold a shard's entry files into its MANIFEST.json. Entry files
+        are renamed out of the way before they are read, so an entry that
+        a job writes meanwhile is kept as a file. Only one compaction per
+        scan may run at a time. '''
+    entry_dir = os.path.join(shard, ENTRY_DIR)
+    try:
+        names = os.listdir(entry_dir)
+    except OSError:
+        return
+    taken = []
+    for name in names:
+        path = os.path.join(entry_dir, name)
+        if name.endswith('.json'):
+            os.rename(path, path + '.compacting')
+            path += '.compacting'
+        elif not name.endswith('.compacting'):
+            # a temporary file of a job writing its entry
+            continue
+        # including those left behind by an interrupted compaction
+        taken.append(path)
+    if not taken:
+        return
+    entries = read_manifest(shard)
+    write_manifest(shard, entries)
+    for path in taken:
+        os.remove(path)
+
+def compact_manifests(root):
+    for shard in manifest_shards(root).itervalues():
+        compact_manifest(shard)
+
+def manifest_shards(root):
+    ''' (xs, mass) -> directory of every shard of a sharded scan '''
+    shards = {}
+    for shard in glob(os.path.join(root, 'x*', 'm*')):
+        parent, mdir = os.path.split(shard)
+        try:
+            shards[(float(os.path.basename(parent)[1:]), int(mdir[1:]))] = shard
+        except ValueError:
+            continue
+    return shards
+
+def manifest_results(root):
+    ''' (xs, mass) -> {path: manifest entry} of a sharded scan directory,
+        including jobs that have not finished '''
+    results = {}
+    for point, shard in manifest_shards(root).iteritems():
+        results[point] = dict((os.path.join(shard, name), entry)
+                for name, entry in read_manifest(shard).iteritems())
+    return results
+
+def manifest_entry(path, d):
+    ''' The manifest entry of a result file read by read_results() '''
+    ngood = int(np.sum(np.max(d['statuses'], axis=1) <= 0)) if len(d['poi']) else 0
+    return dict(seed=d.get('seed'), ntrial=d.get('ntrial'), xsec=d.get('xsec'), mX=d.get('mX'),
+            jobid=d.get('jobid'), complete=d['complete'], nfit=len(d['poi']), ngood=ngood, ntried=d['ntried'],
+            runtime=d['runtime'], size=os.path.getsize(path))
+
+def rebuild_manifests(root, verbose=True):
+    ''' Recreate the manifests of a sharded scan from the result files in
+        its shards, e.g. after a job was killed before it could write its
+        entry. Lists every shard, so this is as slow as a directory scan.
+        No job may be running. '''
+    for shard in manifest_shards(root).itervalues():
+        entries = {}
+        for fname in glob(os.path.join(shard, '*'+EXTENSION)):
+            try:
+                d = read_results(fname)
+            except (EOFError, ValueError, IOError):
+                continue
+            entries[os.path.basename(fname)] = manifest_entry(fname, d)
+        write_manifest(shard, entries)
+        entry_dir = os.path.join(shard, ENTRY_DIR)
+        if os.path.isdir(entry_dir):
+            for name in os.listdir(entry_dir):
+                os.remove(os.path.join(entry_dir, name))
+        if verbose:
+            print "%s: %d jobs"%(shard, len(entries))
+
+def find_results(directory, pattern='*', sharded=True):
+    ''' All result files in a directory: those in it and, unless sharded
+        is False, those in the manifests of its shards. Old-style pickles
+        are only returned if there is no result file for the same job. '''
+    results = glob(os.path.join(directory, pattern+EXTENSION))
+    if sharded:
+        for files in manifest_results(directory).itervalues():
+            results.extend(files)
+    have = set(r[:-len(EXTENSION)] for r in results)
+    for p in glob(os.path.join(directory, pattern+'.npy.pkl')):
+        if p[:-len('.npy.pkl')] not in have:
+            results.append(p)
+    return results
+
+def parse_filename(fname):
+    ''' (xs, mass, job) from a name like fits-x0.25-m300-12.res '''
+    f0 = os.path.basename(fname)
+    for ext in ('.npy.pkl', '.pkl', '.npy', EXTENSION):
+        if f0.endswith(ext):
+            f0 = f0[:-len(ext)]
+            break
+    info = {}
+    items = f0.split('-')[1:]
+    for itm in items:
+        if itm.startswith('x'):
+            info['xs'] = float(itm[1:])
+        elif itm.startswith('m'):
+            info['mass'] = int(itm[1:])
+    if items and items[-1].isdigit():
+        info['job'] = int(items[-1])
+    return info
+
+MERGED_NAME = 'scan.npz'
+
+def merge_scan(directory, verbose=True):
+    ''' Read all result files of a scan directory into one set of columns.
+
+        Per-trial columns: xs, mass, job, trial, poi, vals, errs_lo,
+        errs_hi (the last three with one column per entry of keys; NaN
+        where a job did not fit that parameter), statuses, nll_invalid.
+        Per-job columns are prefixed with job_. '''
+    return merge_files(sorted(find_results(directory)), verbose)
+
+# record fields that merge_files() handles explicitly; the running
+# runtime total is only kept per job.
+COLUMN_FIELDS = ('trial', 'poi', 'vals', 'errs_lo', 'errs_hi', 'statuses', 'nll_invalid', 'runtime')
+
+def merge_files(files, verbose=True):
+    results = []
+    for fname in files:
+        try:
+            d = read_results(fname)
+        except (EOFError, ValueError, IOError) as e:
+            if verbose:
+                print "Warning, skipping unreadable file %s (%s)"%(fname, e)
+            continue
+        info = parse_filename(fname)
+        info.setdefault('xs', d.get('xsec'))
+        info.setdefault('mass', d.get('mX'))
+        info.setdefault('job', -1)
+        results.append((info, d))
+
+    keys = []
+    for info,d in results:
+        for k in d['keys']:
+            if k not in keys:
+                keys.append(k)
+
+    # any further per-trial record fields (call counts, timings, ...)
+    extra = []
+    for info,d in results:
+        if 'records' not in d:
+            continue
+        dtype = d['records'].dtype
+        for name in dtype.names:
+            if name not in COLUMN_FIELDS and name not in [e[0] for e in extra]:
+                extra.append((name, dtype[name]))
+
+    ntot = sum(len(d['poi']) for info,d in results)
+    nkeys = len(keys)
+    cols = dict(
+            xs=np.empty(ntot),
+            mass=np.empty(ntot, dtype=int),
+            job=np.empty(ntot, dtype=int),
+            trial=np.empty(ntot, dtype=int),
+            poi=np.empty(ntot),
+            vals=np.full((ntot, nkeys), np.nan),
+            errs_lo=np.full((ntot, nkeys), np.nan),
+            errs_hi=np.full((ntot, nkeys), np.nan),
+            statuses=np.empty((ntot, NSTATUS), dtype=int),
+            nll_invalid=np.empty(ntot, dtype=int),
+            )
+    for name, dt in extra:
+        fill = np.nan if dt.base.kind == 'f' else -1
+        cols[name] = np.full((ntot,)+dt.shape, fill, dtype=dt.base)
+    njob = len(results)
+    jobs = dict(
+            job_xs=np.empty(njob),
+            job_mass=np.empty(njob, dtype=int),
+            job_index=np.empty(njob, dtype=int),
+            job_ntrial=np.empty(njob, dtype=int),
+            job_ntried=np.empty(njob, dtype=int),
+            job_runtime=np.empty(njob),
+            job_complete=np.empty(njob, dtype=bool),
+            job_import_wall=np.empty(njob),
+            job_asimov=np.empty(njob, dtype=bool),
+            )
+
+    i0 = 0
+    for ijob,(info,d) in enumerate(results):
+        n = len(d['poi'])
+        sl = slice(i0, i0+n)
+        i0 += n
+        cols['xs'][sl] = info['xs']
+        cols['mass'][sl] = info['mass']
+        cols['job'][sl] = info['job']
+        if 'records' in d:
+            cols['trial'][sl] = d['records']['trial']
+        else:
+            cols['trial'][sl] = np.arange(n)
+        cols['poi'][sl] = d['poi']
+        kidx = [keys.index(k) for k in d['keys']]
+        cols['vals'][sl,kidx] = d['vals']
+        cols['errs_lo'][sl,kidx] = d['errs_lo']
+        cols['errs_hi'][sl,kidx] = d['errs_hi']
+        cols['statuses'][sl] = d['statuses']
+        if 'records' in d:
+            cols['nll_invalid'][sl] = d['nll_invalid']
+        else:
+            # old pickles also counted the skipped trials
+            cols['nll_invalid'][sl] = -1
+        for name, dt in extra:
+            if 'records' in d and name in d['records'].dtype.names:
+                cols[name][sl] = d['records'][name]
+
+        jobs['job_xs'][ijob] = info['xs']
+        jobs['job_mass'][ijob] = info['mass']
+        jobs['job_index'][ijob] = info['job']
+        jobs['job_ntrial'][ijob] = n
+        jobs['job_ntried'][ijob] = d['ntried'] if d['ntried'] is not None else n
+        jobs['job_runtime'][ijob] = d['runtime']
+        jobs['job_complete'][ijob] = d['complete']
+        jobs['job_import_wall'][ijob] = d.get('import_wall', np.nan)
+        jobs['job_asimov'][ijob] = d.get('asimov', False)
+
+    cols.update(jobs)
+    cols['keys'] = keys
+    return cols
+
+def save_scan(path, cols):
+    tmp = tmp_name(path) + '.npz'
+    np.savez(tmp, **cols)
+    os.rename(tmp, path)
+
+def load_scan(path, verbose=True):
+    ''' Load a scan, either from a merged file or from a directory. A
+        directory's merged file is used if it is newer than all of the
+        result files, otherwise the directory is read file by file. '''
+    if os.path.isdir(path):
+        merged = os.path.join(path, MERGED_NAME)
+        if os.path.exists(merged):
+            mtime = os.path.getmtime(merged)
+            # a shard's entry directory changes with every job started or
+            # finished in it; running jobs only change their result files
+            files = []
+            for shard in manifest_shards(path).itervalues():
+                files += [p for p in (os.path.join(shard, MANIFEST_NAME), os.path.join(shard, ENTRY_DIR))
+                        if os.path.exists(p)]
+            for entries in manifest_results(path).itervalues():
+                files += [f for f, e in entries.iteritems() if not e.get('complete', True) and os.path.exists(f)]
+            files += glob(os.path.join(path, '*'+EXTENSION)) + glob(os.path.join(path, '*.npy.pkl'))
+            if all(os.path.getmtime(f) <= mtime for f in files):
+                path = merged
+            elif verbose:
+                print "Note: %s is out of date, reading result files instead."%merged
+        if os.path.isdir(path):
+            return merge_scan(path, verbose)
+    with np.load(path) as f:
+        cols = dict(f.items())
+    cols['keys'] = list(cols['keys'])
+    return cols
+
+def good_mask(cols):
+    ''' Trials with all fit statuses 0 (or not run) '''
+    return np.max(cols['statuses'], axis=1) <= 0
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+
+''' Scan driver: run the bias-test.py jobs of an (xsec, mX) grid on SLURM
+or on the cores of the local machine.
+
+Every job is one (xsec, mX, job index) task and writes
+<output_dir>/x<xsec>/m<mX>/fits-x<xsec>-m<mX>-<job>; its seed is mX+job,
+as in submit_example.sh. A job keeps its own entry in the manifest of its
+shard up to date (started, finished), and the driver only reads the
+manifests, so it never lists the result files. Before every round it
+folds the new entries into the manifests (do not run merge-scan.py on
+the scan meanwhile), so a round reads one manifest per shard plus the
+entries written since the previous one. Finished
+tasks are never run again, so an interrupted scan is resumed by running
+the same command again. Jobs that died or left a corrupt result file are
+rerun up to --retries times; so are incomplete result files of jobs the
+driver did not start (e.g. from submit_example.sh) that are no longer
+running.
+
+A quick bias-test.py --asimov scan (one fit per point) can be used to
+pre-screen the grid with --prescreen: points with a small Asimov bias
+first get --min-jobs jobs, and the rest only if their toys disagree.
+With --target-error it only sizes the first round of every point.
+
+By default every point gets --jobs jobs. With --target-error, the driver
+instead reads the results written so far, estimates the standard error of
+the median bias at each point and only queues the jobs a point still
+needs to reach the target (at most --round-jobs per point and round).
+The local backend keeps going round by round until all points have
+converged; with SLURM, the driver returns once a round is queued: run it
+with --dry-run to see how far the jobs have got (per point: done,
+running, to be retried), and without once the round has finished.
+
+Any option not listed below is passed on to bias-test.py, e.g.
+
+    ./scan.py fits-scan --backend local --ws 3000_ggbb_lowmass.root --freeze-bias --only-good
+'''
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import functools
+import subprocess
+import multiprocessing
+import numpy as np
+import resultstore
+import biasstats
+import scancache
+import scanbackend
+
+LEDGER_NAME = 'submitted.json'
+LOG_DIR = 'logs'
+HERE = os.path.dirname(os.path.abspath(__file__))
+BIAS_TEST = os.path.join(HERE, 'bias-test.py')
+
+def parse_range(s):
+    # "260:450:10" -> [260, 270, ..., 450], as in bias-test.py
+    items = map(int, s.split(':'))
+    if len(items) == 1:
+        return items
+    start, stop = items[:2]
+    step = items[2] if len(items) > 2 else 1
+    return range(start, stop+1, step)
+
+def out_name(output_dir, xs, mass, job):
+    return resultstore.shard_out(output_dir, xs, mass, job)
+
+def read_ledger(output_dir):
+    ''' (xs, mass, job) -> dict(attempts, id) of every job run so far.
+        The ledger has one [xs, mass, job, attempts, id] line per
+        submission; the last line of a job wins. '''
+    entries = []
+    try:
+        with open(os.path.join(output_dir, LEDGER_NAME)) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # cut short by an interrupted driver
+                    continue
+                if entry and isinstance(entry[0], list):
+                    # a whole ledger in one line, as written before
+                    entries.extend(entry)
+                else:
+                    entries.append(entry)
+    except IOError:
+        return {}
+    return dict(((float(xs), int(mass), int(job)), dict(attempts=attempts, id=jobid))
+            for xs, mass, job, attempts, jobid in entries)
+
+def ledger_line(key, entry):
+    return json.dumps(list(key) + [entry['attempts'], entry['id']]) + '\n'
+
+def write_ledger(output_dir, ledger):
+    ''' Rewrite the ledger with one line per job '''
+    path = os.path.join(output_dir, LEDGER_NAME)
+    tmp = resultstore.tmp_name(path)
+    with open(tmp, 'w') as f:
+        for key in sorted(ledger):
+            f.write(ledger_line(key, ledger[key]))
+    os.rename(tmp, path)
+
+def append_ledger(output_dir, key, entry):
+    ''' Add the latest state of one job to the ledger '''
+    with open(os.path.join(output_dir, LEDGER_NAME), 'a') as f:
+        f.write(ledger_line(key, entry))
+
+def job_states(output_dir):
+    ''' Job index -> whether its result file is complete, and job index ->
+        id of the batch job that wrote it (None if unknown), per (xs, mass) '''
+    states, ids = {}, {}
+    for point, files in scancache.point_files(output_dir).iteritems():
+        for fname, entry in files.iteritems():
+            job = resultstore.parse_filename(fname).get('job')
+            if job is None:
+                continue
+            if entry is not None:
+                complete = entry.get('complete', True)
+                jobid = entry.get('jobid')
+            else:
+                try:
+                    d = resultstore.read_results(fname)
+                    complete, jobid = d['complete'], d.get('jobid')
+                except (EOFError, ValueError, IOError):
+                    complete, jobid = False, None
+            states.setdefault(point, {})[job] = complete
+            ids.setdefault(point, {})[job] = jobid
+    return states, ids
+
+def recover_entry(output_dir, xs, mass, job):
+    ''' Update the manifest entry of a job that completed its result file
+        but died before it could record that. Returns whether the job is
+        complete. '''
+    path = resultstore.result_path(out_name(output_dir, xs, mass, job))
+    try:
+        d = resultstore.read_results(path)
+    except (EOFError, ValueError, IOError):
+        return False
+    if d['complete']:
+        resultstore.write_entry(os.path.dirname(path), os.path.basename(path),
+                resultstore.manifest_entry(path, d))
+    return d['complete']
+
+def predicted_jobs(asimov, args):
+    ''' Jobs a point needs to reach the target error, from the error of a
+        single fit to its Asimov dataset (the median of n Gaussian values
+        has an error of sqrt(pi/2)*sigma/sqrt(n)). '''
+    if not asimov or not asimov['toy_err'] > 0 or args.target_error is None:
+        return args.min_jobs
+    ntrial = (math.sqrt(math.pi/2)*asimov['toy_err']/args.target_error)**2
+    return max(args.min_jobs, int(math.ceil(ntrial/args.trials_per_job)))
+
+def confirms_asimov(summary, asimov, args):
+    ''' Whether the toys of a point agree with its Asimov fit: a small
+        median bias, consistent with the Asimov bias within twice its
+        error '''
+    if not summary or summary['n'] == 0 or not np.isfinite(summary['err']):
+        return False
+    return (abs(summary['median']) < args.prescreen_threshold and
+            abs(summary['median'] - asimov['median']) < 2*summary['err'])
+
+def jobs_needed(summary, njob, args, max_jobs, first_round):
+    ''' Number of new jobs for a point with njob finished jobs '''
+    if njob < first_round or not summary or summary['n'] == 0:
+        add = max(first_round - njob, 1)
+    elif not summary['err'] > args.target_error:
+        # converged (or no error estimate from too few fits: keep going)
+        if np.isfinite(summary['err']):
+            return 0
+        add = 1
+    else:
+        # the error of the median falls like 1/sqrt(n)
+        per_job = float(summary['n'])/njob
+        missing = summary['n']*((summary['err']/args.target_error)**2 - 1)
+        add = int(math.ceil(missing/per_job))
+    return max(0, min(add, args.round_jobs, max_jobs - njob))
+
+def plan(args, grid, ledger, active):
+    ''' The (xs, mass, job) tasks to run next: failed jobs to retry, then
+        new ones. Prints the state of every point. '''
+    states, ids = job_states(args.output_dir)
+    for (xs, mass, j), v in ledger.iteritems():
+        jobs = states.setdefault((xs, mass), {})
+        if not jobs.get(j) and v['id'] not in active and recover_entry(args.output_dir, xs, mass, j):
+            jobs[j] = True
+    for (xs, mass), jobs in states.iteritems():
+        for j, complete in jobs.items():
+            if (not complete and (xs, mass, j) not in ledger and ids.get((xs, mass), {}).get(j) not in active
+                    and recover_entry(args.output_dir, xs, mass, j)):
+                jobs[j] = True
+    summaries = {}
+    if args.target_error is not None or args.prescreen:
+        summaries = scancache.map_points(args.output_dir,
+                'median_precision:bootstrap=%s'%args.bootstrap,
+                functools.partial(biasstats.median_precision, nboot=args.bootstrap),
+                use_cache=not args.no_cache)
+    prescreen = {}
+    if args.prescreen:
+        prescreen = scancache.map_points(args.prescreen, 'bias_estimate',
+                biasstats.bias_estimate, use_cache=not args.no_cache)
+
+    print "%6s %5s %5s %7s %6s %7s %9s %9s %5s"%('xs', 'mX', 'jobs', 'running', 'retry', 'fits', 'med bias', 'err', 'new')
+    tasks = []
+    warnings = []
+    for xs, mass in grid:
+        point = (float(xs), mass)
+        jobs = states.get(point, {})
+        submitted = dict((k[2], v) for k,v in ledger.iteritems() if k[:2] == point)
+        done = [j for j, complete in jobs.iteritems() if complete]
+        running = [j for j,v in submitted.iteritems() if not jobs.get(j) and v['id'] in active]
+        failed = [j for j,v in submitted.iteritems() if not jobs.get(j) and v['id'] not in active]
+        # incomplete jobs the ledger does not know, e.g. started by
+        # submit_example.sh and killed at the time limit
+        unlisted = [j for j, complete in jobs.iteritems() if not complete and j not in submitted]
+        running += [j for j in unlisted if ids.get(point, {}).get(j) in active]
+        retry = sorted([j for j in failed if submitted[j]['attempts'] <= args.retries] +
+                [j for j in unlisted if ids.get(point, {}).get(j) not in active])
+        for j in failed:
+            if j not in retry:
+                warnings.append("Warning: giving up on %s after %d attempts"%(out_name(args.output_dir, xs, mass, j), submitted[j]['attempts']))
+
+        summary = summaries.get(point)
+        asimov = prescreen.get(point)
+        njob, max_jobs = args.jobs, args.max_jobs
+        if (args.target_error is None and asimov and abs(asimov['median']) < args.prescreen_threshold
+                and (len(done) < args.min_jobs or confirms_asimov(summary, asimov, args))):
+            # small bias expected: a few jobs to check the Asimov fit; the
+            # point gets all of its jobs if their toys disagree with it
+            njob = args.min_jobs
+        if args.target_error is None:
+            new = [j for j in xrange(njob) if j not in jobs and j not in submitted]
+        elif (running or retry) and not args.ignore_pending:
+            # judge the point once the jobs already asked for are in
+            new = []
+        else:
+            first = max(list(jobs.keys()) + list(submitted.keys()) + [-1]) + 1
+            first_round = min(predicted_jobs(asimov, args), max_jobs)
+            new = range(first, first + jobs_needed(summary, len(done), args, max_jobs, first_round))
+        print "%6s %5d %5d %7d %6d %7s %9s %9s %5d"%(xs, mass, len(done), len(running), len(retry),
+                summary['n'] if summary else '-',
+                '%.4f'%summary['median'] if summary else '-',
+                '%.4f'%summary['err'] if summary else '-', len(new))
+        tasks.extend((xs, mass, j) for j in retry + new)
+    for w in warnings:
+        print w
+    return tasks
+
+def command(args, bias_test_args, xs, mass, job):
+    # bias-test.py itself, as sbatch wants a script with a #! line; the
+    # local backend runs it with this interpreter
+    return [BIAS_TEST,
+            '--xsec', xs,
+            '--ntrial', str(args.trials_per_job),
+            '--seed', str(mass+job),
+            '--mX', str(mass),
+            '--out', args.output_dir,
+            '--sharded',
+            '--job', str(job),
+            ] + bias_test_args
+
+class Progress(object):
+    ''' Keeps the ledger up to date and prints the progress of a round.
+        Only backends that wait for their jobs report them as finished;
+        the progress of a SLURM round is shown by running the driver again
+        with --dry-run. '''
+    def __init__(self, output_dir, ledger, ntask, trials_per_job):
+        self.output_dir = output_dir
+        self.ledger = ledger
+        self.ntask = ntask
+        self.trials_per_job = trials_per_job
+        self.nfinished = 0
+        self.nfailed = 0
+        self.start = time.time()
+
+    def submitted(self, key, jobid):
+        key = (float(key[0]),) + key[1:]
+        entry = self.ledger.setdefault(key, dict(attempts=0, id=None))
+        entry['attempts'] += 1
+        entry['id'] = jobid
+        append_ledger(self.output_dir, key, entry)
+
+    def finished(self, key, returncode, elapsed):
+        self.nfinished += 1
+        status = 'ok'
+        if returncode != 0:
+            self.nfailed += 1
+            status = 'FAILED (%d)'%returncode
+        wall = time.time() - self.start
+        rate = 3600.*(self.nfinished - self.nfailed)*self.trials_per_job/wall
+        eta = (self.ntask - self.nfinished)*wall/self.nfinished
+        print "[%d/%d] x%s m%d job %d %s after %.0f s; %.0f trials/hour, %d failed, ETA %.0f min"%(
+                self.nfinished, self.ntask, key[0], key[1], key[2], status, elapsed,
+                rate, self.nfailed, eta/60.)
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+            epilog="All other options are passed on to bias-test.py.")
+    parser.add_argument("--xsec", default="0.0,0.25,0.5,0.75,1.0", help="Comma separated cross sections to scan")
+    parser.add_argument("--mX", default="260:450:10", help="Masses to scan as start:stop:step (inclusive)")
+    parser.add_argument("--trials-per-job", type=int, default=50, help="Number of trials per job")
+    parser.add_argument("--jobs", type=int, default=100, help="Number of jobs per point (without --target-error)")
+    parser.add_argument("--target-error", type=float, help="Run jobs until the standard error of the median bias of every point is below this [pb]")
+    parser.add_argument("--min-jobs", type=int, default=10, help="Jobs every point gets before its precision is judged")
+    parser.add_argument("--max-jobs", type=int, default=100, help="Never run more jobs than this for a point")
+    parser.add_argument("--round-jobs", type=int, default=20, help="At most this many new jobs per point and round")
+    parser.add_argument("--bootstrap", metavar="N", type=int, help="Estimate the error of the median from N bootstrap samples rather than from the order statistics")
+    parser.add_argument("--prescreen", metavar="DIR", help="Results of a bias-test.py --asimov scan. With --target-error, the first round of every point is sized from its Asimov fit error. Otherwise, points whose Asimov bias is below --prescreen-threshold first get --min-jobs jobs, and only get all --jobs jobs if the toys of those disagree with the Asimov fit")
+    parser.add_argument("--prescreen-threshold", type=float, default=0.01, help="Asimov (and toy) bias below which a point is not scanned in full [pb]")
+    parser.add_argument("--ignore-pending", action="store_true", help="Judge points even if some of their jobs are still running or to be retried")
+    parser.add_argument("--retries", type=int, default=2, help="Rerun a job that died or left a corrupt result file at most this many times")
+    parser.add_argument("--backend", choices=['slurm', 'local'], default='slurm', help="Where to run the jobs")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="Number of jobs to run at once with the local backend")
+    parser.add_argument("--partition", default="hep", help="SLURM partition")
+    parser.add_argument("--timelimit", type=int, default=20, help="SLURM time limit per job [min]")
+    parser.add_argument("--report", metavar="DIR", help="Once a local scan is done, write the plot.py and plot-pulls.py reports to DIR")
+    parser.add_argument("--dry-run", action="store_true", help="Only print what would be run")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use or update the cache in the scan directory")
+    parser.add_argument("output_dir", help="The directory of the scan's fit results")
+    args, bias_test_args = parser.parse_known_args()
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    if args.backend == 'slurm':
+        backend = scanbackend.SlurmBackend(args.partition, args.timelimit)
+    else:
+        backend = scanbackend.LocalBackend(args.workers)
+
+    log_dir = os.path.join(args.output_dir, LOG_DIR)
+
+    # the same spelling of every xsec as in bias-test.py's shard names
+    grid = [(str(float(xs)), mass) for xs in args.xsec.split(',') for mass in parse_range(args.mX)]
+    ledger = read_ledger(args.output_dir)
+    if ledger and not args.dry_run:
+        # drop the superseded lines of earlier runs
+        write_ledger(args.output_dir, ledger)
+
+    while True:
+        active = set() if args.dry_run else backend.active()
+        if not args.dry_run:
+            # so that reading the manifests costs one file per shard plus
+            # the entries written during the last round
+            resultstore.compact_manifests(args.output_dir)
+        tasks = plan(args, grid, ledger, active)
+        print "%s %d jobs (%d trials)"%('Would run' if args.dry_run else 'Running', len(tasks), len(tasks)*args.trials_per_job)
+        runs = []
+        for xs, mass, job in tasks:
+            out = out_name(args.output_dir, xs, mass, job)
+            runs.append(((xs, mass, job), command(args, bias_test_args, xs, mass, job),
+                os.path.join(log_dir, os.path.basename(out)+'.log')))
+        if args.dry_run:
+            for key, cmd, log in runs:
+                print ' '.join(cmd)
+            break
+        if not runs:
+            break
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        progress = Progress(args.output_dir, ledger, len(runs), args.trials_per_job)
+        backend.run(runs, progress)
+        if not backend.waits:
+            print "Queued; run again with --dry-run to see how far the jobs have got"
+            break
+
+    if args.report and backend.waits and not args.dry_run:
+        # the local backend only gets here once the scan is done
+        for script, opts in (('plot.py', ['--bootstrap', '1000']), ('plot-pulls.py', [])):
+            subprocess.check_call([sys.executable, os.path.join(HERE, script), '--report', args.report,
+                '--workers', str(args.workers)] + opts + [args.output_dir])
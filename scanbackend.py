@@ -0,0 +1,73 @@
+''' Backends that run the bias-test.py jobs of scan.py.
+
+A backend gets a list of (key, command, log file) tasks, where the
+command starts with the path of a script that has a #! line. run() starts
+them and reports every job through a progress object: submitted(key, id)
+when a job has been handed to the backend and, for backends that wait
+for their jobs, finished(key, returncode, elapsed). active() returns the
+ids of jobs of earlier runs that may still be running, so that the
+driver can tell them apart from jobs that died.
+'''
+
+import os
+import sys
+import time
+import getpass
+import subprocess
+
+class SlurmBackend(object):
+    ''' One batch job per task. run() returns once everything is queued. '''
+    waits = False
+
+    def __init__(self, partition, timelimit):
+        self.partition = partition
+        self.timelimit = timelimit
+
+    def active(self):
+        out = subprocess.check_output(['squeue', '-h', '-o', '%i', '-u', getpass.getuser()])
+        return set(out.split())
+
+    def run(self, tasks, progress):
+        for key, cmd, log in tasks:
+            out = subprocess.check_output(['sbatch', '--parsable', '-o', log,
+                '-p', self.partition, '-t', str(self.timelimit)] + cmd)
+            progress.submitted(key, out.strip().split(';')[0])
+
+class LocalBackend(object):
+    ''' At most `workers` jobs at a time as child processes of the driver.
+        Jobs still running when the driver is interrupted are killed, so
+        nothing of an earlier run can be active. '''
+    waits = True
+
+    def __init__(self, workers, poll=0.5):
+        self.workers = workers
+        self.poll = poll
+        self.njob = 0
+
+    def active(self):
+        return set()
+
+    def run(self, tasks, progress):
+        queue = list(tasks)
+        running = {}
+        try:
+            while queue or running:
+                while queue and len(running) < self.workers:
+                    key, cmd, log = queue.pop(0)
+                    jobid = 'local-%d-%d'%(os.getpid(), self.njob)
+                    self.njob += 1
+                    env = dict(os.environ, SCAN_JOBID=jobid)
+                    with open(log, 'w') as f:
+                        p = subprocess.Popen([sys.executable] + cmd, stdout=f, stderr=subprocess.STDOUT, env=env)
+                    running[p] = (key, time.time())
+                    progress.submitted(key, jobid)
+                time.sleep(self.poll)
+                for p in running.keys():
+                    if p.poll() is not None:
+                        key, t0 = running.pop(p)
+                        progress.finished(key, p.returncode, time.time() - t0)
+        finally:
+            for p in running:
+                p.terminate()
+            for p in running:
+                p.wait()
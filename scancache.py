@@ -0,0 +1,137 @@
+''' Cache of per-grid-point analysis products of a scan directory.
+
+Each grid point's entry lives in <scan dir>/.cache/ and is keyed by the
+names, sizes and modification times of the result files of that point
+(for a sharded scan, by the point's manifest entries, so that nothing but
+the manifests has to be read to find the points that changed).
+Only points whose files changed since the last run are re-read and
+recomputed; entries of points whose files are gone are removed.
+'''
+
+import os
+import hashlib
+import cPickle
+import multiprocessing
+import numpy as np
+import resultstore
+import biasstats
+
+CACHE_DIR = '.cache'
+
+def point_files(directory):
+    ''' Result files of a scan directory grouped by (xs, mass), as a dict
+        of path -> manifest entry (None for files of a flat directory) '''
+    points = resultstore.manifest_results(directory)
+    for fname in resultstore.find_results(directory, sharded=False):
+        info = resultstore.parse_filename(fname)
+        if 'xs' not in info or 'mass' not in info:
+            continue
+        points.setdefault((info['xs'], info['mass']), {})[fname] = None
+    return points
+
+def fingerprint(files):
+    h = hashlib.sha1()
+    for fname in sorted(files):
+        entry = files[fname]
+        if entry is None or not entry.get('complete', True):
+            # a running job only changes its result file
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            h.update('%s %d %r\n'%(os.path.basename(fname), st.st_size, st.st_mtime))
+        else:
+            h.update('%s %d %r\n'%(os.path.basename(fname), entry['size'], entry['runtime']))
+    return h.hexdigest()
+
+def entry_name(point):
+    return 'x%s-m%d.pkl'%point
+
+def _compute(task):
+    fn, point, files = task
+    return fn(point, resultstore.merge_files(sorted(files), verbose=False))
+
+def map_points(path, name, fn, workers=1, use_cache=True, verbose=True):
+    ''' Apply fn(point, cols) to the trials of every (xs, mass) point of a
+        scan and return a dict mapping the points to the results.
+
+        For a scan directory, the results are cached under name, which has
+        to encode any options that fn depends on. A merged scan file is
+        simply split up by point. fn must be a module-level function (or a
+        partial of one) if workers > 1. '''
+    if not os.path.isdir(path):
+        scan = resultstore.load_scan(path, verbose)
+        pts, group = biasstats.grid_points(scan)
+        out = {}
+        for ipt,pt in enumerate(pts):
+            point = (float(pt['xs']), int(pt['mass']))
+            out[point] = fn(point, select(scan, group == ipt))
+        return out
+
+    points = point_files(path)
+    cache_dir = os.path.join(path, CACHE_DIR)
+    if use_cache and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    out = {}
+    todo = []
+    entries = {}
+    for point, files in sorted(points.iteritems()):
+        fp = fingerprint(files)
+        entry = dict(fingerprint=fp, products={})
+        if use_cache:
+            try:
+                with open(os.path.join(cache_dir, entry_name(point)), 'rb') as f:
+                    cached = cPickle.load(f)
+                if cached['fingerprint'] == fp:
+                    entry = cached
+            except (IOError, EOFError, cPickle.UnpicklingError):
+                pass
+        entries[point] = entry
+        if name in entry['products']:
+            out[point] = entry['products'][name]
+        else:
+            todo.append((fn, point, files))
+
+    if todo and verbose:
+        print "Computing %s for %d of %d grid points"%(name, len(todo), len(points))
+    if todo:
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            results = pool.map(_compute, todo)
+            pool.close()
+            pool.join()
+        else:
+            results = map(_compute, todo)
+        for (fn, point, files), result in zip(todo, results):
+            out[point] = result
+            entries[point]['products'][name] = result
+            if use_cache:
+                write_entry(cache_dir, point, entries[point])
+
+    if use_cache:
+        # evict entries of points that no longer have any files
+        keep = set(entry_name(point) for point in points)
+        for fname in os.listdir(cache_dir):
+            if fname.endswith('.pkl') and fname not in keep:
+                os.remove(os.path.join(cache_dir, fname))
+
+    return out
+
+def write_entry(cache_dir, point, entry):
+    path = os.path.join(cache_dir, entry_name(point))
+    tmp = '%s.tmp.%d'%(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+
+def select(cols, mask):
+    ''' The per-trial columns of the trials in mask '''
+    ntrial = len(cols['poi'])
+    out = {}
+    for k,v in cols.iteritems():
+        if isinstance(v, np.ndarray) and not k.startswith('job_') and len(v) == ntrial:
+            out[k] = v[mask]
+        else:
+            out[k] = v
+    return out
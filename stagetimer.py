@@ -0,0 +1,50 @@
+''' Wall and CPU time accounting for the stages of a bias-test.py job. '''
+
+import os
+import time
+import resource
+
+# setup stages are charged to the first trial run by each process
+STAGES = ['load', 'edit', 'generate', 'ghost', 'nll', 'migrad', 'hesse', 'minos', 'profile', 'plot', 'output']
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+def peak_rss():
+    ''' Peak resident set size of this process so far [MB] '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+class StageTimer(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.wall = dict((s, 0.) for s in STAGES)
+        self.cpu = dict((s, 0.) for s in STAGES)
+        self.mark()
+
+    def mark(self):
+        self._w0, self._c0 = time.time(), cpu_time()
+
+    def lap(self, name):
+        ''' Charge the time since the last mark() or lap() to a stage '''
+        w, c = time.time(), cpu_time()
+        self.wall[name] += w - self._w0
+        self.cpu[name] += c - self._c0
+        self._w0, self._c0 = w, c
+
+    def record(self):
+        ''' The accumulated times as result record fields '''
+        rec = {}
+        for s in STAGES:
+            rec['wall_'+s] = self.wall[s]
+            rec['cpu_'+s] = self.cpu[s]
+        return rec
+
+def record_fields():
+    fields = []
+    for s in STAGES:
+        fields.append(('wall_'+s, '<f4'))
+        fields.append(('cpu_'+s, '<f4'))
+    return fields
@@ -10,6 +10,11 @@ timelimit=20
 
 mkdir -p $output_dir
 
+# every job writes into the shard of its point, $output_dir/x<xsec>/m<mX>/,
+# and keeps an entry in the shard's manifest (manifest.d/) up to date, so
+# the analysis scripts never have to list thousands of result files.
+# merge-scan.py folds the entries into one MANIFEST.json per shard.
+
 for i in {0..99}; do
 	for xsec in 0.0 0.25 0.5 0.75 1.0; do
 		for mX in {260..450..10}; do
@@ -22,7 +27,53 @@ for i in {0..99}; do
 				--seed $((mX+i)) \
 				--mX $mX \
 				--only-good \
-				--out $output_dir/fits-x${xsec}-m${mX}-${i}.npy;
+				--sharded --job $i \
+				--out $output_dir;
 		done
 	done
 done
+
+# alternatively, submit one job per block of seeds that scans the whole
+# grid in-process (the workspace is loaded only once per job):
+#
+#for i in {0..99}; do
+#	sbatch -o /dev/null -p $batch_partition -t $((timelimit*100)) \
+#	./bias-test.py \
+#		--ws 3000_ggbb_lowmass.root \
+#		--freeze-bias \
+#		--scan-xsec 0.0,0.25,0.5,0.75,1.0 \
+#		--scan-mX 260:450:10 \
+#		--ntrial $trials_per_job \
+#		--seed $i \
+#		--only-good \
+#		--sharded \
+#		--out $output_dir;
+#done
+
+# or let scan.py run the scan, on SLURM or on the local cores. It skips
+# jobs that already finished and reruns failed ones, so an interrupted scan
+# is resumed by running it again. With --target-error it only runs the jobs
+# each point still needs to reach that precision of the median bias:
+#
+#./scan.py $output_dir --backend slurm --target-error 0.005 \
+#	--trials-per-job $trials_per_job --partition $batch_partition --timelimit $timelimit \
+#	--ws 3000_ggbb_lowmass.root --freeze-bias --only-good
+#
+#./scan.py $output_dir --backend local --workers 32 --jobs 100 \
+#	--trials-per-job $trials_per_job \
+#	--ws 3000_ggbb_lowmass.root --freeze-bias --only-good
+#
+# a quick Asimov scan (one fit per point) can pre-screen the grid first:
+#
+#./bias-test.py --ws 3000_ggbb_lowmass.root --freeze-bias --asimov \
+#	--scan-xsec 0.0,0.25,0.5,0.75,1.0 --scan-mX 260:450:10 --seed 0 --out asimov-scan
+#./scan.py $output_dir --prescreen asimov-scan --target-error 0.005 ...
+#./compare-scans.py $output_dir asimov-scan
+#
+# to fit several configurations to the same toys, generate them once and
+# fit slices of the bank in parallel:
+#
+#./bias-test.py --ws 3000_ggbb_lowmass.root --mX 300 --xsec 0.5 --seed 300 \
+#	--ntrial 5000 --generate-bank toys-x0.5-m300.bank
+#./bias-test.py --ws 3000_ggbb_lowmass.root --mX 300 --xsec 0.5 --freeze-bias \
+#	--from-bank toys-x0.5-m300.bank --bank-range 0:50 --out $output_dir/fits-x0.5-m300-0
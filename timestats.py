@@ -1,44 +1,113 @@
 #!/usr/bin/env python
 
 import sys, os
+import json
+import argparse
 import numpy as np
-from glob import glob
-import cPickle
-import numpy as np
+import resultstore
+import stagetimer
+
+def percentiles(x, qs):
+    return [float(p) for p in np.percentile(x, qs)]
+
+def time_summary(scan):
+    ''' Job, fit and per-stage timing figures of a scan as a dict '''
+    times = scan['job_runtime']
+    processed = scan['job_ntrial']
+    s = dict(
+            unfinished_jobs=int(np.sum(~scan['job_complete'])),
+            total_trials=int(np.sum(processed)),
+            avg_processed=float(np.mean(processed)),
+            processed_frac=float(np.sum(processed))/(len(processed)*np.max(processed)),
+            avg_time=float(np.mean(times)),
+            std_time=float(np.std(times)),
+            median_time=float(np.median(times)),
+            time_per_trial=1.*np.sum(times)/np.sum(processed),
+            )
+    if 'fit_time' in scan:
+        has = np.isfinite(scan['fit_time']) & (scan['ncall_migrad'] >= 0)
+        if np.any(has):
+            s['ncall_migrad_per_fit'] = float(np.mean(scan['ncall_migrad'][has]))
+            s['time_per_fit'] = float(np.mean(scan['fit_time'][has]))
+    if 'recovery' in scan:
+        steps = scan['recovery'][scan['recovery'] >= 0]
+        if np.any(steps > 0):
+            s['retry_steps'] = [int(n) for n in np.bincount(steps)]
+
+    stages = [st for st in stagetimer.STAGES if 'wall_'+st in scan]
+    if stages:
+        has = np.isfinite(scan['wall_'+stages[0]])
+        wall = dict((st, scan['wall_'+st][has]) for st in stages)
+        cpu = dict((st, scan['cpu_'+st][has]) for st in stages)
+        total_wall = np.sum([np.sum(wall[st]) for st in stages])
+        s['ntimed'] = int(np.sum(has))
+        s['stages'] = []
+        for st in stages:
+            p50, p90, p99 = percentiles(wall[st], [50, 90, 99])
+            s['stages'].append(dict(stage=st, mean=float(np.mean(wall[st])), p50=p50, p90=p90, p99=p99,
+                    max=float(np.max(wall[st])), wall_frac=float(np.sum(wall[st])/total_wall),
+                    cpu_per_wall=float(np.sum(cpu[st])/np.sum(wall[st])) if np.sum(wall[st]) > 0 else None))
+        per_trial = np.sum([wall[st] for st in stages], axis=0)
+        p50, p90, p99 = percentiles(per_trial, [50, 90, 99])
+        s['per_trial'] = dict(mean=float(np.mean(per_trial)), p50=p50, p90=p90, p99=p99, max=float(np.max(per_trial)))
+        if 'job_import_wall' in scan and np.any(np.isfinite(scan['job_import_wall'])):
+            s['import_wall'] = dict(mean=float(np.nanmean(scan['job_import_wall'])), max=float(np.nanmax(scan['job_import_wall'])))
+        s['trials_per_hour_per_core'] = 3600.*s['ntimed']/total_wall
+        for k in ('ncall_migrad', 'ncall_minos', 'ncall_profile'):
+            if k not in scan:
+                continue
+            ok = has & (scan[k] >= 0)
+            if not np.any(ok):
+                continue
+            s[k] = dict(zip(('mean', 'p50', 'p90', 'p99'), [float(np.mean(scan[k][ok]))] + percentiles(scan[k][ok], [50, 90, 99])))
+        rss = scan['peak_rss'][has]
+        s['peak_rss'] = dict(zip(('p50', 'p90', 'max'), percentiles(rss, [50, 90]) + [float(np.max(rss))]))
+    return s
+
+def print_summary(s):
+    print "Unfinished jobs:", s['unfinished_jobs']
+    print 'Total trials:', s['total_trials']
+    print "Avg processed: %.2f (%.2f%%)" % (s['avg_processed'], 100.*s['processed_frac'])
+    print "Avg time: %.2f (std=%.2f)"%(s['avg_time'], s['std_time'])
+    print "Median time: %.2f"%s['median_time']
+    print "Avg time/trial:", s['time_per_trial']
+    if 'time_per_fit' in s:
+        print "Avg migrad calls/fit: %.1f"%s['ncall_migrad_per_fit']
+        print "Avg time/fit: %.3f"%s['time_per_fit']
+    if 'retry_steps' in s:
+        print "Retry steps taken by the stored fits:", ', '.join('%d: %d'%(k, n) for k,n in enumerate(s['retry_steps']) if n)
+
+    if 'stages' in s:
+        print
+        print "Per-trial stage times [s] (%d trials):"%s['ntimed']
+        print "  %-9s %9s %9s %9s %9s %9s %7s %7s"%('stage', 'mean', 'p50', 'p90', 'p99', 'max', 'wall%', 'cpu/wall')
+        for st in s['stages']:
+            print "  %-9s %9.4f %9.4f %9.4f %9.4f %9.4f %6.1f%% %7.2f"%(
+                    st['stage'], st['mean'], st['p50'], st['p90'], st['p99'], st['max'],
+                    100.*st['wall_frac'], st['cpu_per_wall'] if st['cpu_per_wall'] is not None else np.nan)
+        t = s['per_trial']
+        print "  %-9s %9.4f %9.4f %9.4f %9.4f %9.4f"%('total', t['mean'], t['p50'], t['p90'], t['p99'], t['max'])
+        if 'import_wall' in s:
+            print "ROOT import per job [s]: mean %.2f, max %.2f"%(s['import_wall']['mean'], s['import_wall']['max'])
+        print "Throughput: %.1f trials/hour/core"%s['trials_per_hour_per_core']
+        for k in ('ncall_migrad', 'ncall_minos', 'ncall_profile'):
+            if k not in s:
+                continue
+            c = s[k]
+            print "%s: mean %.1f, p50 %.0f, p90 %.0f, p99 %.0f"%(k, c['mean'], c['p50'], c['p90'], c['p99'])
+        rss = s['peak_rss']
+        print "Peak RSS [MB]: p50 %.0f, p90 %.0f, max %.0f"%(rss['p50'], rss['p90'], rss['max'])
 
 if __name__ == "__main__":
-    #infile = open(sys.argv[1])
-    #times = []
-    #for l in infile:
-    #    h,m,s = map(int, l.split(":"))
-    #    times.append(h*3600 + m*60 + s)
-    #print np.mean(times)
-    ntotal = 0
-    nfail = 0
-    nmissing = 0
-    input_files = glob(os.path.join(sys.argv[1], "*.pkl"))
-    times = []
-    processed = []
-    for fname in input_files:
-        try:
-            d = cPickle.load(open(fname))
-        except EOFError:
-            print "Skipping corrupt file", fname
-            continue
-        jid = d['jobid']
-        ntotal += len(d['statuses'])
-        nfail += max(max(d['statuses']))
-        #timeinfo = open('slurm-%s.out'%jid).readlines()[-1]
-        #if not timeinfo.startswith("Total time"):
-        #    nmissing += 1
-        #    continue
-        #times.append(float(timeinfo.split(':')[1]))
-        times.append(d['runtime'])
-        processed.append(len(d['statuses']))
-    #print "Failure rate: %.2f%%" % (100.*nfail/ntotal)
-    print "Missing time infos:", nmissing
-    print 'Total trials:', np.sum(processed)
-    print "Avg processed: %.2f (%.2f%%)" % (np.mean(processed), 100.*np.sum(processed)/(len(input_files)*np.max(processed)))
-    print "Avg time: %.2f (std=%.2f)"%(np.mean(times), np.std(times))
-    print "Median time: %.2f"%np.median(times)
-    print "Avg time/trial:", 1.*np.sum(times)/np.sum(processed)
+    parser = argparse.ArgumentParser(description="Job and per-stage timing summary of a scan")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    parser.add_argument("input", help="The directory containing fit results, or a merged scan file")
+    args = parser.parse_args()
+
+    scan = resultstore.load_scan(args.input, verbose=not args.json)
+    s = time_summary(scan)
+    if args.json:
+        json.dump(s, sys.stdout, indent=1, sort_keys=True)
+        print
+    else:
+        print_summary(s)
@@ -0,0 +1,98 @@
+''' Banks of pre-generated bias-test.py toys.
+
+A bank holds all toys of one grid point, so that different fit
+configurations can be run on exactly the same pseudo-data:
+
+    magic[8] complete[1] pad[3] header_len[4] nevent[8] ntoy[4] pad[4]
+    header[header_len]      JSON (point, seed, column names, ...), padded
+                            to a multiple of 8 bytes
+    event, event, ...       (category index, observable) of every event
+    offsets[ntoy+1]         int64; toy i is events[offsets[i]:offsets[i+1]]
+
+The bank is written under a temporary name and renamed when complete.
+Readers memory-map the events, so a job that fits a slice of the toys
+only reads those.
+'''
+
+import os
+import json
+import struct
+import numpy as np
+
+MAGIC = 'BBYYTOY1'
+PREAMBLE = struct.Struct('<8sB3xIQI4x')
+EXTENSION = '.bank'
+
+def event_dtype(obs_name, cat_name):
+    return np.dtype([(str(cat_name), '<i4'), (str(obs_name), '<f8')])
+
+def bank_name(xs, mass):
+    return 'toys-x%s-m%d%s'%(xs, mass, EXTENSION)
+
+def parse_slice(s):
+    ''' "START:STOP" -> (start, stop); either may be left out '''
+    items = s.split(':')
+    if len(items) != 2:
+        raise ValueError("Not a START:STOP range: %s"%s)
+    return tuple(int(x) if x else None for x in items)
+
+class BankWriter(object):
+    def __init__(self, path, obs_name, cat_name, **header):
+        self.path = path
+        self.dtype = event_dtype(obs_name, cat_name)
+        self.offsets = [0]
+
+        header['obs'] = obs_name
+        header['cat'] = cat_name
+        hdr = json.dumps(header)
+        hdr += ' '*(-(PREAMBLE.size + len(hdr)) % 8)
+        self.hdr_len = len(hdr)
+        self.tmp = '%s.tmp.%d'%(path, os.getpid())
+        self.f = open(self.tmp, 'wb')
+        self.f.write(PREAMBLE.pack(MAGIC, 0, len(hdr), 0, 0))
+        self.f.write(hdr)
+
+    def append(self, indices, values):
+        ''' Add a toy from arrays of category indices and observable values '''
+        events = np.empty(len(values), dtype=self.dtype)
+        events[self.dtype.names[0]] = indices
+        events[self.dtype.names[1]] = values
+        self.f.write(events.tobytes())
+        self.offsets.append(self.offsets[-1] + len(events))
+
+    def close(self):
+        self.f.write(np.array(self.offsets, dtype='<i8').tobytes())
+        self.f.seek(0)
+        self.f.write(PREAMBLE.pack(MAGIC, 1, self.hdr_len, self.offsets[-1], len(self.offsets)-1))
+        self.f.close()
+        os.rename(self.tmp, self.path)
+
+class ToyBank(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, complete, hdr_len, nevent, ntoy = PREAMBLE.unpack(f.read(PREAMBLE.size))
+            if magic != MAGIC:
+                raise ValueError("Not a toy bank: %s"%path)
+            if not complete:
+                raise ValueError("Incomplete toy bank: %s"%path)
+            self.header = json.loads(f.read(hdr_len))
+        self.dtype = event_dtype(self.header['obs'], self.header['cat'])
+        start = PREAMBLE.size + hdr_len
+        if nevent:
+            self.events = np.memmap(path, dtype=self.dtype, mode='r', offset=start, shape=(nevent,))
+        else:
+            self.events = np.zeros(0, dtype=self.dtype)
+        self.offsets = np.memmap(path, dtype='<i8', mode='r',
+                offset=start + nevent*self.dtype.itemsize, shape=(ntoy+1,))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def toy(self, i):
+        ''' (category indices, observable values) of toy i '''
+        events = self.events[self.offsets[i]:self.offsets[i+1]]
+        return events[self.dtype.names[0]], events[self.dtype.names[1]]
+
+    def trials(self, start=None, stop=None):
+        return range(len(self))[start:stop]